@@ -0,0 +1,910 @@
+'''
+Tests for walker.py: the modes of the diagrams in diagrams/ against the original implementation, and the
+building blocks that the modes depend on. Run with "python -m pytest tests" from the top of the repository.
+'''
+
+from __future__ import print_function
+import gzip
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import walker as module
+from walker import (BackgroundWriter, Benchmark, BlockCutTree, BuildDictionaries, CompactGraph, DiagramCache,
+                    DiagramGenerator, FactStore, FeatureSamples, Networks, Stats, TargetBatch,
+                    sample_fold_negatives, walker)
+
+DIAGRAMS = sorted(name for name in os.listdir(os.path.join(ROOT, 'diagrams')) if name.endswith('.mayukh'))
+
+# The modes of the original walker.py for every diagram, with random.seed(1) for -rw.
+with open(os.path.join(ROOT, 'tests', 'expected_modes.json')) as f:
+    EXPECTED = json.load(f)
+
+def read_diagram(name):
+    with open(os.path.join(ROOT, 'diagrams', name)) as f:
+        return f.read()
+
+def write(filename, text):
+    with open(filename, 'w') as f:
+        f.write(text)
+
+def run_walker(arguments):
+    output = subprocess.check_output([sys.executable, os.path.join(ROOT, 'walker.py')] + arguments, cwd=ROOT)
+    return output.decode('utf-8')
+
+def modes_of(output):
+    return [line for line in output.splitlines() if line.startswith('//target is') or line.startswith('mode:')]
+
+@pytest.mark.parametrize('key', sorted(EXPECTED))
+def test_modes_match_the_original(key):
+    name, arguments = key.split(' ', 1)
+    arguments = arguments.split()
+    if '-rw' in arguments:
+        arguments += ['--seed', '1']
+    assert modes_of(run_walker(arguments + [os.path.join('diagrams', name)])) == EXPECTED[key]
+
+# Path enumeration
+
+def find_all_paths(graph, start, end, path=[]):
+    # The recursive recipe of https://www.python.org/doc/essays/graphs/ that walker.py started from.
+    path = path + [start]
+    if start == end:
+        return [path]
+    if start not in graph:
+        return []
+    paths = []
+    for node in graph[start]:
+        if node not in path:
+            paths.extend(find_all_paths(graph, node, end, path))
+    return paths
+
+@pytest.mark.parametrize('name', DIAGRAMS)
+def test_paths_come_out_like_the_recursive_recipe(name):
+    dictionaries = BuildDictionaries(read_diagram(name))
+    features = sorted(set(dictionaries.relations_dict).union(dictionaries.attribute_dict))
+    networks = Networks(dictionaries.target, features, dictionaries)
+    names = networks.names
+    for feature, paths in zip(features, networks.paths_from_target_to_features()):
+        assert [[names[node] for node in path] for path in paths] == \
+            find_all_paths(dictionaries.Graph, dictionaries.target, feature)
+
+# BlockCutTree
+
+def simple_path_nodes(graph, start, end):
+    '''Every node on some simple path from start to end, by enumerating the paths.'''
+    nodes = set()
+    stack = [[start]]
+    while stack:
+        path = stack.pop()
+        if path[-1] == end:
+            nodes.update(path)
+            continue
+        for neighbor in graph.neighbors(path[-1]):
+            if neighbor not in path:
+                stack.append(path + [neighbor])
+    return nodes
+
+def test_block_cut_tree_on_a_small_graph():
+    # a - b - c - a is a cycle, c - d a bridge, d - e - f - d another cycle, g is on its own.
+    edges = [('a', 'b'), ('b', 'c'), ('c', 'a'), ('c', 'd'), ('d', 'e'), ('e', 'f'), ('f', 'd')]
+    adjacency = {'g': []}
+    for left, right in edges:
+        adjacency.setdefault(left, []).append(right)
+        adjacency.setdefault(right, []).append(left)
+    graph = CompactGraph(adjacency, sorted(adjacency), [], [])
+    tree = BlockCutTree(graph)
+    ids = graph.ids
+
+    def names(nodes):
+        return set(graph.names[node] for node in nodes)
+
+    assert names(tree.relevant(ids['a'], ids['e'])) == set('abcdef')
+    assert names(tree.relevant(ids['a'], ids['b'])) == set('abc')
+    assert names(tree.relevant(ids['c'], ids['d'])) == set('cd')
+    assert names(tree.relevant(ids['a'], ids['a'])) == set('a')
+    assert tree.relevant(ids['a'], ids['g']) == set()
+
+@pytest.mark.parametrize('name', ['imdb.mayukh', 'webkb.mayukh', 'cora.mayukh'])
+def test_block_cut_tree_matches_the_simple_paths(name):
+    dictionaries = BuildDictionaries(read_diagram(name))
+    graph = dictionaries.compact_graph
+    tree = dictionaries.block_cut_tree
+    for start in range(len(graph)):
+        for end in range(len(graph)):
+            assert tree.relevant(start, end) == simple_path_nodes(graph, start, end)
+
+# DiagramCache
+
+def test_diagram_cache_round_trip(tmp_path):
+    diagram = read_diagram('uwcse.mayukh')
+    directory = str(tmp_path)
+    parsed = BuildDictionaries(diagram, cache=DiagramCache(directory))
+    cache = DiagramCache(directory)
+    assert cache.load(diagram) is not None
+
+    loaded = BuildDictionaries(diagram, cache=cache)
+    for field in BuildDictionaries.compiled_fields:
+        assert getattr(loaded, field) == getattr(parsed, field)
+
+    paths = {('advisedby', 'student'): [['advisedby', 'Person', 'student']]}
+    cache.store_paths(diagram, paths)
+    assert DiagramCache(directory).load_paths(diagram, 'advisedby', 'student') == [['advisedby', 'Person', 'student']]
+    assert DiagramCache(directory).load_paths(diagram, 'advisedby', 'professor') is None
+    # Another diagram, or an edited one, misses.
+    assert DiagramCache(directory).load(diagram + '\n') is None
+
+def test_diagram_cache_evicts_the_least_recently_used(tmp_path):
+    directory = str(tmp_path)
+    first, second = read_diagram('imdb.mayukh'), read_diagram('webkb.mayukh')
+    cache = DiagramCache(directory)
+    cache.store(first, {'target': 'workedunder'})
+    cache.store(second, {'target': 'faculty'})
+    first_file, second_file = cache.filename(cache.key(first)), cache.filename(cache.key(second))
+    os.utime(first_file, (1000, 1000))
+    os.utime(second_file, (2000, 2000))
+
+    # Reading the first entry makes it the most recently used one.
+    reader = DiagramCache(directory, max_bytes=max(os.path.getsize(first_file), os.path.getsize(second_file)))
+    assert reader.load(first)['dictionaries'] == {'target': 'workedunder'}
+    reader.evict()
+    assert os.path.exists(first_file)
+    assert not os.path.exists(second_file)
+
+    # A damaged entry is a miss, not an error.
+    with gzip.open(first_file, 'wb') as f:
+        f.write(b'{"dictionaries": ')
+    assert DiagramCache(directory).load(first) is None
+
+# walker
+
+def count_networks(monkeypatch):
+    built = []
+    class CountingNetworks(Networks):
+        def __init__(self, *arguments, **keywords):
+            built.append((arguments[0], list(arguments[1])))
+            Networks.__init__(self, *arguments, **keywords)
+    monkeypatch.setattr(module, 'Networks', CountingNetworks)
+    return built
+
+@pytest.mark.parametrize('name', DIAGRAMS)
+def test_walker_api_matches_the_command_line(name):
+    api = walker(read_diagram(name))
+    assert ['//target is ' + api.dictionaries.target] + api.walk() == EXPECTED[name + ' -w']
+    assert ['//target is ' + api.dictionaries.target] + api.shortest() == EXPECTED[name + ' -s']
+    assert ['//target is ' + api.dictionaries.target] + api.exhaustive() == EXPECTED[name + ' -e']
+    assert api.exhaustive(boostsrl=True) == [mode[len('mode: '):] for mode in api.exhaustive()]
+
+def test_walker_remembers_results(monkeypatch):
+    api = walker(read_diagram('uwcse.mayukh'))
+    importants = api.dictionaries.importants
+    built = count_networks(monkeypatch)
+    modes = api.walk(number=2)
+    # One Networks for the query, one to walk to the features.
+    assert built == [('advisedby', importants[:2])] * 2
+
+    # The same query, also with boostsrl or the same features passed explicitly, does not walk again.
+    modes.append('mode: changed(+Person).')
+    assert api.walk(number=2) == modes[:-1]
+    api.walk(number=2, boostsrl=True)
+    api.walk(features=importants[:2])
+    assert api.random_walk(depth=20, seed=3) == api.random_walk(depth=20, seed=3)
+    assert len(built) == 3
+
+    # A longer feature list is a new query, but only walks to the feature that was not walked to yet.
+    del built[:]
+    api.walk(number=3)
+    assert built == [('advisedby', importants[:3]), ('advisedby', importants[2:3])]
+
+def test_walker_does_not_remember_budgeted_or_unseeded_results(monkeypatch):
+    api = walker(read_diagram('uwcse.mayukh'), max_paths=1)
+    built = count_networks(monkeypatch)
+    api.exhaustive()
+    api.exhaustive()
+    api.random_walk(depth=20)
+    api.random_walk(depth=20)
+    assert [target for target, features in built] == ['advisedby'] * 4
+    assert api.memo == {}
+
+# TargetBatch
+
+def read_modes(filename):
+    with open(filename) as f:
+        return modes_of(f.read())
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_target_batch_writes_the_modes_of_every_target(tmp_path, processes):
+    api = walker(read_diagram('uwcse.mayukh'))
+    batch = TargetBatch(api.dictionaries, 'walk', number=3, processes=processes)
+    assert batch.targets == sorted(set(api.dictionaries.relations_dict).union(api.dictionaries.attribute_dict))
+
+    files = batch.run(str(tmp_path))
+    assert files == sorted(str(tmp_path / (target + '.txt')) for target in batch.targets)
+    for target in batch.targets:
+        features = [feature for feature in api.dictionaries.importants if feature != target][:3]
+        assert read_modes(str(tmp_path / (target + '.txt'))) == \
+            ['//target is ' + target] + api.walk(target=target, features=features)
+
+def test_target_batch_refuses_unknown_targets():
+    dictionaries = BuildDictionaries(read_diagram('uwcse.mayukh'))
+    with pytest.raises(module.ExceptionCase):
+        TargetBatch(dictionaries, 'walk', targets=['advisedby', 'Person'])
+
+# Random walks
+
+def ensemble(name, walks, seed, numpy=True, **keywords):
+    dictionaries = BuildDictionaries(read_diagram(name))
+    networks = Networks(dictionaries.target, [], dictionaries)
+    if not numpy:
+        networks.sample_walks_numpy = networks.sample_walks_python
+    networks.random_walk_ensemble(networks.graph, networks.target_id, 10000, walks, seed=seed, **keywords)
+    return networks
+
+@pytest.mark.parametrize('name', DIAGRAMS)
+def test_random_walk_ensemble_is_the_same_with_and_without_numpy(name):
+    pytest.importorskip('numpy')
+    for window in (None, 4):
+        batched = ensemble(name, 300, 5, window=window)
+        looped = ensemble(name, 300, 5, numpy=False, window=window)
+        assert batched.walk_steps == looped.walk_steps
+        assert batched.walk_stop_reasons == looped.walk_stop_reasons
+        assert batched.mode_frequencies == looped.mode_frequencies
+        assert batched.all_modes == looped.all_modes
+
+def test_random_walk_ensemble_keeps_the_modes_above_the_threshold():
+    networks = ensemble('uwcse.mayukh', 200, 1, numpy=False, threshold=0.3)
+    frequencies = networks.mode_frequencies
+    assert all(0 < fraction <= 1 for fraction in frequencies.values())
+    assert networks.all_modes_boostsrl == sorted(mode for mode, fraction in frequencies.items() if fraction >= 0.3)
+    # Every walk produces the modes of the target.
+    for mode in networks.random_walk_target_modes():
+        assert frequencies[mode] == 1.0
+    assert sum(networks.walk_stop_reasons.values()) == 200
+
+    again = ensemble('uwcse.mayukh', 200, 1, numpy=False, threshold=0.3)
+    assert again.mode_frequencies == frequencies
+
+def random_walk(name, depth, seed, window=None):
+    dictionaries = BuildDictionaries(read_diagram(name))
+    networks = Networks(dictionaries.target, [], dictionaries)
+    steps = networks.random_walk(networks.graph, networks.target_id, depth, rng=random.Random(seed), window=window)
+    assert steps == networks.walk_steps
+    return networks
+
+@pytest.mark.parametrize('name', DIAGRAMS)
+def test_random_walk_stops_once_its_modes_are_saturated(name):
+    walks = [random_walk(name, 10000, seed) for seed in range(5)]
+    for networks in walks:
+        assert networks.walk_stop_reason == 'coverage'
+        assert networks.walk_steps < 9999
+        # A saturated walk produces everything a walk from the target can.
+        assert networks.all_modes == walks[0].all_modes
+
+def test_random_walk_window_and_depth():
+    short = random_walk('uwcse.mayukh', 5, 1)
+    assert (short.walk_stop_reason, short.walk_steps) == ('depth', 4)
+    for seed in range(5):
+        networks = random_walk('uwcse.mayukh', 10000, seed, window=2)
+        assert networks.walk_stop_reason in ('window', 'coverage')
+    assert 'window' in [random_walk('uwcse.mayukh', 10000, seed, window=1).walk_stop_reason for seed in range(5)]
+
+    output = run_walker(['-rw', '--seed', '1', '--window', '1', 'diagrams/uwcse.mayukh'])
+    assert 'Random walk stopped after' in output
+
+def test_random_walk_ensemble_stops_walks_early():
+    networks = ensemble('imdb.mayukh', 100, 2, numpy=False, window=3)
+    assert networks.walk_steps < 100 * 9999
+    assert set(networks.walk_stop_reasons) <= set(['coverage', 'window'])
+
+# -n / --nowalk
+
+def check_nowalk(diagram):
+    api = walker(diagram)
+    target = api.dictionaries.target
+    assert api.nowalk() == api.shortest(features=api.all_features(target))
+
+@pytest.mark.parametrize('name', DIAGRAMS)
+def test_nowalk_is_shortest_over_every_feature(name):
+    check_nowalk(read_diagram(name))
+    api = walker(read_diagram(name))
+    output = run_walker(['-n', os.path.join('diagrams', name)])
+    assert modes_of(output) == ['//target is ' + api.dictionaries.target] + api.nowalk()
+
+@pytest.mark.parametrize('settings', [{}, {'entities': 6, 'relations': 8, 'attributes': 5, 'reflexive': 2,
+                                           'multi_valued': 2, 'density': 0.7},
+                                      {'entities': 8, 'relations': 10, 'attributes': 6, 'arity': 4}])
+def test_nowalk_is_shortest_over_every_feature_on_generated_diagrams(settings):
+    for seed in range(40):
+        check_nowalk(DiagramGenerator(seed=seed, **settings).generate())
+
+# Budgets
+
+def budgeted_paths(name, **budgets):
+    dictionaries = BuildDictionaries(read_diagram(name))
+    features = walker(None, dictionaries=dictionaries).all_features(dictionaries.target)
+    networks = Networks(dictionaries.target, features, dictionaries, **budgets)
+    paths = networks.paths_from_target_to_features()
+    return networks, [set(tuple(path) for path in feature_paths) for feature_paths in paths]
+
+@pytest.mark.parametrize('name', ['uwcse.mayukh', 'citeseer.mayukh'])
+def test_depth_budget_keeps_the_short_paths(name):
+    unbounded, every_path = budgeted_paths(name)
+    roomy, paths = budgeted_paths(name, max_depth=100)
+    assert paths == every_path
+    assert roomy.budget_hit is None
+
+    for depth in (1, 2, 3):
+        networks, paths = budgeted_paths(name, max_depth=depth)
+        assert paths == [set(path for path in feature_paths if len(path) - 1 <= depth) for feature_paths in every_path]
+        assert networks.budget_hit == 'depth'
+        assert networks.explored_depth == depth
+        assert 'the depth budget' in networks.budget_summary()
+
+def test_path_budget_keeps_a_shortest_path():
+    unbounded, every_path = budgeted_paths('uwcse.mayukh')
+    networks, paths = budgeted_paths('uwcse.mayukh', max_paths=1)
+    assert networks.budget_hit == 'paths'
+    for kept, feature_paths in zip(paths, every_path):
+        assert len(kept) == min(1, len(feature_paths))
+        if kept:
+            assert len(list(kept)[0]) == min(len(path) for path in feature_paths)
+
+def test_time_budget_still_gives_modes():
+    api = walker(read_diagram('uwcse.mayukh'), time_budget=1e-9)
+    modes = api.exhaustive()
+    assert modes and all(mode.startswith('mode: ') for mode in modes)
+    networks, paths = budgeted_paths('uwcse.mayukh', time_budget=1e-9)
+    assert networks.budget_hit == 'time'
+
+def test_budget_summary_and_deepening_stats():
+    output = run_walker(['-e', '--max-depth', '2', 'diagrams/uwcse.mayukh'])
+    assert 'stopped by the depth budget (2 edges)' in output
+
+    api = walker(read_diagram('uwcse.mayukh'), max_depth=3, stats=True)
+    api.exhaustive()
+    counters = api.stats.as_dict()['counters']
+    # One traversal per path length from 0 to 3 edges, each walking again what the one before walked.
+    assert counters['deepening_passes'] == 4
+    assert 0 < counters['deepening_repeated_calls'] < counters['path_calls']
+
+# Networks.path_powerset
+
+@pytest.mark.parametrize('name', ['imdb.mayukh', 'webkb.mayukh'])
+def test_path_powerset_yields_each_subset_once(name):
+    dictionaries = BuildDictionaries(read_diagram(name))
+    networks = Networks(dictionaries.target, dictionaries.importants, dictionaries)
+    all_paths = networks.paths_from_target_to_features()
+    yielded = [tuple(modes) for modes in networks.path_powerset(all_paths)]
+    assert len(yielded) == len(set(yielded))
+
+    # Every subset of the paths, walked one at a time.
+    paths = list(itertools.chain(*all_paths))
+    expected = set()
+    for size in range(len(paths) + 1):
+        for subset in itertools.combinations(paths, size):
+            networks.walkFeatures([list(subset)])
+            expected.add(tuple(networks.all_modes))
+    assert set(yielded) == expected
+
+# --sweep
+
+@pytest.mark.parametrize('name', DIAGRAMS)
+def test_sweep_gives_the_modes_of_each_number_of_features(name):
+    api = walker(read_diagram(name))
+    dictionaries = api.dictionaries
+    for shortest in (False, True):
+        networks = Networks(dictionaries.target, dictionaries.importants, dictionaries)
+        if shortest:
+            all_paths = networks.shortest_paths_from_target_to_features()
+        else:
+            all_paths = networks.paths_from_target_to_features()
+        swept = [list(modes) for modes in networks.sweep_features(all_paths, shortest=shortest)]
+        assert len(swept) == len(dictionaries.importants)
+        for number, modes in enumerate(swept, 1):
+            expected = api.shortest(number=number) if shortest else api.walk(number=number)
+            assert modes == expected
+
+def test_sweep_writes_one_file_per_number(tmp_path):
+    run_walker(['-w', '--sweep', '--output-dir', str(tmp_path), 'diagrams/uwcse.mayukh'])
+    api = walker(read_diagram('uwcse.mayukh'))
+    numbers = range(1, len(api.dictionaries.importants) + 1)
+    assert sorted(os.listdir(str(tmp_path))) == sorted('advisedby_%d.txt' % number for number in numbers)
+    for number in numbers:
+        assert read_modes(str(tmp_path / ('advisedby_%d.txt' % number))) == \
+            ['//target is advisedby'] + api.walk(number=number)
+
+# FeatureSamples
+
+def read_samples(directory):
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+    return manifest, [(sample['features'], read_modes(os.path.join(directory, sample['file'])))
+                      for sample in manifest['samples']]
+
+@pytest.mark.parametrize('budgets', [None, {'max_depth': None, 'max_paths': 1, 'time_budget': None}])
+def test_feature_samples_walk_each_subset(tmp_path, budgets):
+    runs = []
+    for processes in (1, 2):
+        api = walker(read_diagram('uwcse.mayukh'), **(budgets or {}))
+        stats = Stats()
+        samples = FeatureSamples(api.dictionaries, 8, number=3, seed=4, processes=processes, budgets=budgets,
+                                 stats=stats)
+        directory = str(tmp_path / str(processes))
+        files = samples.run(directory)
+        manifest, modes = read_samples(directory)
+        assert (manifest['target'], manifest['seed'], manifest['number']) == ('advisedby', 4, 3)
+        assert len(manifest['samples']) == 8
+        for features, sample_modes in modes:
+            assert len(features) == 3
+            assert sample_modes == ['//target is advisedby'] + api.walk(features=features)
+        # Subsets with the same modes share a file.
+        assert len(files) == len(set(tuple(sample_modes) for features, sample_modes in modes))
+        subsets = set(frozenset(features) for features, sample_modes in modes)
+        assert stats.phases['instantiate']['calls'] == len(subsets)
+        runs.append(modes)
+    assert runs[0] == runs[1]
+
+# BackgroundWriter
+
+def make_dataset(directory, folds=('train1', 'test1')):
+    os.makedirs(directory)
+    name = os.path.basename(directory)
+    for fold in folds:
+        os.makedirs(os.path.join(directory, fold))
+        write(os.path.join(directory, fold, fold + '_bk.txt'), 'import: "../' + name + '_bk.txt".\n')
+    return directory
+
+def read_text(filename):
+    with open(filename) as f:
+        return f.read()
+
+def test_background_writer_writes_the_dataset_background(tmp_path):
+    dataset = make_dataset(str(tmp_path / 'imdb'), ('train1', 'train2', 'test1'))
+    write(os.path.join(dataset, 'train2', 'train2_bk.txt'), 'mode: actor(+person).\n')
+    writer = BackgroundWriter(dataset, settings=[('treeDepth', '4')])
+    written = writer.write([('workedunder', ['mode: actor(+personid).', 'mode: workedunder(+personid,+personid).'])])
+
+    assert written == [os.path.join(dataset, 'imdb_bk.txt'), os.path.join(dataset, 'train2', 'train2_bk.txt')]
+    assert read_text(written[0]) == ('setParam: treeDepth=4.\n\n//target is workedunder\nmode: actor(+personid).\n'
+                                     'mode: workedunder(+personid,+personid).\n')
+    for fold in ('train1', 'train2', 'test1'):
+        assert read_text(os.path.join(dataset, fold, fold + '_bk.txt')) == 'import: "../imdb_bk.txt".\n'
+    assert not [name for name in os.listdir(dataset) if name.endswith('.tmp')]
+
+def test_write_bk_from_the_command_line(tmp_path):
+    dataset = make_dataset(str(tmp_path / 'imdb'))
+    run_walker(['-w', 'diagrams/imdb.mayukh', '--write-bk', dataset])
+    lines = read_text(os.path.join(dataset, 'imdb_bk.txt')).splitlines()
+    assert lines[:2] == ['setParam: treeDepth=3.', 'setParam: nodeSize=3.']
+    assert modes_of('\n'.join(lines)) == EXPECTED['imdb.mayukh -w']
+
+    with pytest.raises(subprocess.CalledProcessError):
+        run_walker(['-w', '--sweep', 'diagrams/imdb.mayukh', '--write-bk', dataset])
+
+def test_write_bk_for_every_dataset_of_a_batch(tmp_path):
+    datasets = str(tmp_path / 'datasets')
+    for name in ('imdb', 'webkb'):
+        make_dataset(os.path.join(datasets, name))
+    output = str(tmp_path / 'modes')
+    run_walker(['-w', '--batch', 'diagrams', '--output-dir', output, '--write-bk', datasets])
+    for name in ('imdb', 'webkb'):
+        background = read_text(os.path.join(datasets, name, name + '_bk.txt'))
+        assert modes_of(background) == EXPECTED[name + '.mayukh -w']
+    with open(os.path.join(output, 'index.json')) as f:
+        entries = dict((os.path.basename(entry['diagram']), entry) for entry in json.load(f)['diagrams'])
+    assert entries['imdb.mayukh']['background'] == os.path.join(datasets, 'imdb', 'imdb_bk.txt')
+    assert entries['cora.mayukh']['background'] is None
+    assert entries['cora.mayukh']['error'] is None
+
+# sample_fold_negatives
+
+def sample(tmp_path, diagram, target, positives, facts, ratio, seed=1):
+    dictionaries = BuildDictionaries(read_diagram(diagram))
+    fold_dir = tmp_path / 'train1'
+    fold_dir.mkdir()
+    write(str(fold_dir / 'train1_pos.txt'), ''.join(target + '(' + ', '.join(example) + ').\n' for example in positives))
+    write(str(fold_dir / 'train1_facts.txt'), facts)
+    job = (str(fold_dir), 'train1', target, dictionaries.relations_dict, dictionaries.attribute_dict,
+           dictionaries.multi_value_attributes, ratio, seed)
+    filename, number_positives, number_negatives = sample_fold_negatives(job)
+    with open(filename) as f:
+        negatives = [line.strip() for line in f if line.strip()]
+    assert len(negatives) == number_negatives
+    assert number_positives == len(positives)
+    return negatives
+
+def test_sample_fold_negatives_has_no_self_pairs(tmp_path):
+    negatives = sample(tmp_path, 'imdb.mayukh', 'workedunder', [('p1', 'p2')],
+                       'actor(p1).\nactor(p2).\nactor(p3).\nactor(p4).\n', ratio=3)
+    assert len(negatives) == 3
+    for negative in negatives:
+        first, second = negative[len('workedunder('):-len(').')].split(', ')
+        assert first != second
+    assert 'workedunder(p1, p2).' not in negatives
+
+def test_sample_fold_negatives_is_limited_to_the_allowed_pairs(tmp_path):
+    # Three people make six ordered pairs of different people, one of which is positive.
+    negatives = sample(tmp_path, 'imdb.mayukh', 'workedunder', [('p1', 'p2')], 'actor(p3).\n', ratio=10)
+    assert sorted(negatives) == ['workedunder(p1, p3).', 'workedunder(p2, p1).', 'workedunder(p2, p3).',
+                                 'workedunder(p3, p1).', 'workedunder(p3, p2).']
+
+def test_sample_fold_negatives_of_a_multi_valued_attribute(tmp_path):
+    # The value of hasposition is typed by the attribute: only positions that appear in hasposition facts.
+    facts = 'hasposition(p3, faculty_adjunct).\nstudent(p4).\ninphase(p4, pre_quals).\n'
+    negatives = sample(tmp_path, 'uwcse.mayukh', 'hasposition', [('p1', 'faculty'), ('p2', 'faculty')], facts,
+                       ratio=10)
+    assert len(negatives) == 4 * 2 - 2
+    for negative in negatives:
+        person, position = negative[len('hasposition('):-len(').')].split(', ')
+        assert person in ('p1', 'p2', 'p3', 'p4')
+        assert position in ('faculty', 'faculty_adjunct')
+
+def test_sample_fold_negatives_refuses_examples_of_the_wrong_arity(tmp_path):
+    with pytest.raises(module.ExceptionCase):
+        sample(tmp_path, 'uwcse.mayukh', 'hasposition', [('p1',)], 'student(p4).\n', ratio=1)
+    # The negatives of the fold are left alone.
+    assert not (tmp_path / 'train1' / 'train1_neg.txt').exists()
+
+def test_sample_negatives_for_a_target_from_the_command_line(tmp_path):
+    dataset = make_dataset(str(tmp_path / 'uwcse'), ('train1', 'test1'))
+    for fold in ('train1', 'test1'):
+        write(os.path.join(dataset, fold, fold + '_pos.txt'), 'student(p1).\nstudent(p2).\n')
+        write(os.path.join(dataset, fold, fold + '_facts.txt'), 'professor(p3).\nprofessor(p4).\nprofessor(p5).\n')
+    run_walker(['diagrams/uwcse.mayukh', '--targets', 'student', '--sample-negatives', dataset, '--seed', '1',
+                '--ratio', '1'])
+    for fold in ('train1', 'test1'):
+        negatives = read_text(os.path.join(dataset, fold, fold + '_neg.txt')).splitlines()
+        assert len(negatives) == 2
+        assert all(negative.startswith('student(p') for negative in negatives)
+        assert not set(negatives) & set(['student(p1).', 'student(p2).'])
+
+    with pytest.raises(subprocess.CalledProcessError):
+        run_walker(['diagrams/uwcse.mayukh', '--targets', 'student,professor', '--sample-negatives', dataset])
+
+# FactStore
+
+FACTS = '''actor(p1).
+movie(m1, p1).
+movie(m1, p2).
+workedunder(p2, p1).
+'''
+
+def test_fact_store_reads_the_facts(tmp_path):
+    facts = str(tmp_path / 'train1_facts.txt')
+    write(facts, FACTS)
+    store = FactStore(facts)
+    assert sorted(store.predicates()) == ['actor', 'movie', 'workedunder']
+    assert store.count('movie') == 2
+    assert store.arity('movie') == 2
+    assert sorted(store.facts('movie')) == [('m1', 'p1'), ('m1', 'p2')]
+    assert store.constants('movie', 1) == set(['p1', 'p2'])
+    store.close()
+
+    # Opened again from the map without parsing the facts.
+    assert sorted(FactStore(facts).facts('workedunder')) == [('p2', 'p1')]
+
+def test_fact_store_is_rebuilt_when_the_facts_change(tmp_path):
+    facts = str(tmp_path / 'train1_facts.txt')
+    write(facts, FACTS)
+    FactStore(facts).close()
+    write(facts, FACTS + 'actor(p2).\n')
+    assert FactStore(facts).count('actor') == 2
+
+@pytest.mark.parametrize('keep', [0, 10, 30, -8])
+def test_fact_store_is_rebuilt_when_truncated(tmp_path, keep):
+    facts = str(tmp_path / 'train1_facts.txt')
+    write(facts, FACTS)
+    store = FactStore(facts)
+    store.close()
+    with open(store.store_file, 'rb') as f:
+        data = f.read()
+    with open(store.store_file, 'wb') as f:
+        f.write(data[:keep])
+
+    rebuilt = FactStore(facts)
+    assert sorted(rebuilt.facts('movie')) == [('m1', 'p1'), ('m1', 'p2')]
+    with open(store.store_file, 'rb') as f:
+        assert f.read() == data
+
+def test_fact_store_columns_share_the_map(tmp_path):
+    facts = str(tmp_path / 'train1_facts.txt')
+    write(facts, FACTS)
+    store = FactStore(facts)
+    column = store.column('movie', 1)
+    assert [store.constant_names()[i] for i in column] == ['p1', 'p2']
+    if hasattr(memoryview, 'cast'):
+        assert isinstance(column, memoryview)
+    # Closing the store with a column still in use is fine.
+    store.close()
+    assert len(column) == 2
+
+# DiagramGenerator and Benchmark
+
+def reachable(dictionaries):
+    graph = dictionaries.compact_graph
+    seen = set([graph.ids[dictionaries.target]])
+    frontier = list(seen)
+    while frontier:
+        frontier = [node for current in frontier for node in graph.neighbors(current) if node not in seen]
+        seen.update(frontier)
+    return set(graph.names[node] for node in seen)
+
+@pytest.mark.parametrize('name', list(Benchmark.configurations))
+def test_generated_diagrams_are_valid(name):
+    settings = dict(Benchmark.configurations[name])
+    diagram = DiagramGenerator(**settings).generate()
+    assert diagram == DiagramGenerator(**settings).generate()
+    assert len(diagram.splitlines()) == 6
+
+    dictionaries = BuildDictionaries(diagram)
+    assert len(dictionaries.entities) == settings['entities']
+    assert len(dictionaries.relations) == settings['relations']
+    assert len(dictionaries.attributes) == settings['attributes']
+    arity = settings.get('arity', 2)
+    reflexive = [relation for relation, entities in dictionaries.relations_dict.items() if len(entities) == 1]
+    assert len(reflexive) == settings.get('reflexive', 0)
+    assert all(len(entities) <= arity for entities in dictionaries.relations_dict.values())
+    assert len(dictionaries.multi_value_attributes) == settings.get('multi_valued', 0)
+    assert dictionaries.target in dictionaries.relations_dict
+    assert set(dictionaries.importants) <= set(dictionaries.relations).union(dictionaries.attributes)
+    # One connected component, so every feature can be walked to.
+    assert reachable(dictionaries) == set(dictionaries.entities + dictionaries.relations + dictionaries.attributes)
+
+def test_benchmark_walks_the_paths_of_the_baseline():
+    with open(os.path.join(ROOT, 'benchmarks', 'baseline.json')) as f:
+        baseline = json.load(f)
+    configurations = dict((name, Benchmark.configurations[name]) for name in ('small', 'reflexive'))
+    benchmark = Benchmark(configurations, repeat=1)
+    results = benchmark.run()
+    assert list(results['small']) == ['parse'] + Benchmark.modes
+    for name, modes in results.items():
+        for mode, result in modes.items():
+            assert result['paths'] == baseline[name][mode]['paths']
+
+    # A different number of paths, or a much slower mode, is a regression; comparing with itself is not.
+    assert benchmark.compare(results, results) == []
+    changed = json.loads(json.dumps(results))
+    changed['small']['walk']['paths'] += 1
+    changed['small']['shortest']['seconds'] = 0.0
+    results['small']['shortest']['seconds'] = 1.0
+    regressions = benchmark.compare(results, changed)
+    assert len(regressions) == 2
+    assert regressions[0].startswith('small walk: walked')
+    assert regressions[1].startswith('small shortest: took')
+
+# Stats
+
+def stats_with(phases, counters, peak):
+    stats = Stats()
+    stats.phases = phases
+    stats.counters = counters
+    as_dict = stats.as_dict()
+    as_dict['peak_memory_kb'] = peak
+    return as_dict
+
+def test_stats_merge_adds_phases_and_counters():
+    stats = Stats()
+    stats.count('walks', 2)
+    stats.count('paths_per_feature', 1, key='advisedby|publication')
+    stats.merge(stats_with({'walk': {'wall': 1.0, 'cpu': 0.5, 'calls': 2}}, {'walks': 3,
+                           'paths_per_feature': {'advisedby|publication': 2, 'advisedby|ta': 4}}, 10 ** 9))
+    stats.merge(stats_with({'walk': {'wall': 2.0, 'cpu': 1.5, 'calls': 1}}, {'walks': 1}, None))
+    assert stats.phases['walk'] == {'wall': 3.0, 'cpu': 2.0, 'calls': 3}
+    assert stats.counters['walks'] == 6
+    assert dict(stats.counters['paths_per_feature']) == {'advisedby|publication': 3, 'advisedby|ta': 4}
+    assert stats.as_dict()['peak_memory_kb'] == 10 ** 9
+
+def test_stats_merge_keeps_prefixed_counters_apart():
+    stats = Stats()
+    for prefix in ('first', 'second'):
+        stats.merge(stats_with({}, {'paths_per_feature': {'t|f': 2}}, None), prefix=prefix)
+    assert dict(stats.counters['paths_per_feature']) == {'first|t|f': 2, 'second|t|f': 2}
+
+def paths_per_feature(output):
+    line = [line for line in output.splitlines() if line.startswith('//stats:')][0]
+    return json.loads(line[len('//stats:'):])['counters']['paths_per_feature']
+
+def test_paths_per_feature_are_kept_per_target(tmp_path):
+    counters = paths_per_feature(run_walker(['-w', '--all-targets', '--processes', '2', '--stats', '--output-dir',
+                                             str(tmp_path), os.path.join(ROOT, 'diagrams', 'webkb.mayukh')]))
+    targets = set(key.split('|')[0] for key in counters)
+    assert len(targets) > 1
+    for target in targets:
+        alone = paths_per_feature(run_walker(['-w', '--targets', target, '--stats', '--output-dir',
+                                              str(tmp_path / target), os.path.join(ROOT, 'diagrams', 'webkb.mayukh')]))
+        assert dict((key, number) for key, number in counters.items() if key.startswith(target + '|')) == alone
+
+def test_paths_per_feature_are_kept_per_diagram(tmp_path):
+    directory = tmp_path / 'diagrams'
+    directory.mkdir()
+    for name in ('first', 'second'):
+        write(str(directory / (name + '.mayukh')), read_text(os.path.join(ROOT, 'diagrams', 'webkb.mayukh')))
+    counters = paths_per_feature(run_walker(['-w', '--batch', str(directory), '--output-dir', str(tmp_path / 'out'),
+                                             '--processes', '2', '--stats']))
+    first = dict((key[len('first|'):], number) for key, number in counters.items() if key.startswith('first|'))
+    second = dict((key[len('second|'):], number) for key, number in counters.items() if key.startswith('second|'))
+    assert first and first == second
+    assert len(first) + len(second) == len(counters)
+
+# ModeServer
+
+def test_mode_server_job_parses_a_request():
+    server = module.ModeServer(cache_size=2)
+    diagram = read_diagram('uwcse.mayukh')
+    job = server.job({'diagram': diagram, 'mode': 'shortest', 'features': ['publication'], 'number': 2, 'id': 7})
+    key = job[0]
+    assert job[1:] == (diagram, 2, 'shortest', None, ('publication',), 2, None, False)
+    # The diagram is only sent once, then known by its id.
+    assert server.job({'diagram_id': key}) == (key, diagram, 2, 'walk', None, None, None, None, False)
+    assert module.run_server_job(job) == walker(diagram).modes('shortest', features=('publication',), number=2)
+
+def test_mode_server_keeps_the_last_diagrams():
+    server = module.ModeServer(cache_size=2)
+    keys = [server.job({'diagram': read_diagram(name)})[0] for name in ('uwcse.mayukh', 'imdb.mayukh')]
+    server.job({'diagram_id': keys[0]})
+    server.job({'diagram': read_diagram('cora.mayukh')})
+    assert list(server.diagrams)[0] == keys[0]
+    with pytest.raises(module.ExceptionCase):
+        server.job({'diagram_id': keys[1]})
+
+@pytest.mark.parametrize('request_', [
+    [], {}, {'diagram_id': 'unknown'}, {'diagram': 'too\nshort'}, {'diagram': 3},
+    {'diagram': read_diagram('uwcse.mayukh'), 'mode': 'fast'},
+    {'diagram': read_diagram('uwcse.mayukh'), 'mode': 1},
+    {'diagram': read_diagram('uwcse.mayukh'), 'features': 'publication'},
+    {'diagram': read_diagram('uwcse.mayukh'), 'features': [1]},
+    {'diagram': read_diagram('uwcse.mayukh'), 'number': '2'},
+    {'diagram': read_diagram('uwcse.mayukh'), 'number': True},
+    {'diagram': read_diagram('uwcse.mayukh'), 'seed': 1.5},
+    {'diagram': read_diagram('uwcse.mayukh'), 'boostsrl': 'yes'},
+    {'diagram': read_diagram('uwcse.mayukh'), 'target': ['advisedby']}])
+def test_mode_server_refuses_malformed_requests(request_):
+    with pytest.raises(module.ExceptionCase) as error:
+        module.ModeServer().job(request_)
+    assert str(error.value).startswith('Error [1]: ')
+
+def test_mode_server_repeats_only_seeded_random_modes():
+    server = module.ModeServer()
+    diagram = read_diagram('uwcse.mayukh')
+    assert server.repeatable(server.job({'diagram': diagram, 'mode': 'walk'}))
+    assert server.repeatable(server.job({'diagram': diagram, 'mode': 'random', 'seed': 1}))
+    assert not server.repeatable(server.job({'diagram': diagram, 'mode': 'randomwalk'}))
+
+@pytest.mark.skipif(sys.version_info[0] < 3 or not hasattr(socket, 'AF_UNIX'), reason='Python 3 and Unix sockets')
+def test_mode_server_answers_over_a_socket(tmp_path):
+    address = str(tmp_path / 'walker.sock')
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'walker.py'), '--serve', address,
+                                '--processes', '1'], cwd=ROOT, stdout=subprocess.PIPE)
+    try:
+        # The server says so once it is listening.
+        assert process.stdout.readline().decode('utf-8').startswith('Serving modes on')
+        client = socket.socket(socket.AF_UNIX)
+        client.connect(address)
+        answers = client.makefile('r')
+        diagram = read_diagram('uwcse.mayukh')
+        requests = [{'id': 1, 'diagram': diagram}, 'not json', {'id': 2, 'diagram_id': 'unknown'}]
+        client.sendall(b''.join((request if isinstance(request, str) else json.dumps(request)).encode('utf-8') +
+                                b'\n' for request in requests))
+        # Errors are answered at once, modes when the walk is done: the ids say which answer is which.
+        responses = dict((response.get('id'), response) for response in
+                         [json.loads(answers.readline()) for request in requests])
+        assert responses[1]['modes'] == walker(diagram).walk()
+        assert responses[None]['error'].startswith('Expecting value')
+        assert responses[2]['error'].startswith('Error [1]: Unknown diagram_id')
+        client.sendall(json.dumps({'id': 3, 'diagram_id': responses[1]['diagram_id']}).encode('utf-8') + b'\n')
+        assert json.loads(answers.readline()) == dict(responses[1], id=3)
+        client.close()
+    finally:
+        process.terminate()
+        process.wait()
+
+# DiagramBatch
+
+def malformed_diagrams(directory):
+    diagram = read_diagram('uwcse.mayukh')
+    write(os.path.join(directory, 'uwcse.mayukh'), diagram)
+    write(os.path.join(directory, 'style.mayukh'), diagram.replace('=EntityNodeStyle', '=SquareNodeStyle', 1))
+    write(os.path.join(directory, 'unparsable.mayukh'), diagram.replace('=EntityNodeStyle', '', 1))
+    write(os.path.join(directory, 'short.mayukh'), '\n'.join(diagram.splitlines()[:5]))
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_diagram_batch_reports_malformed_diagrams(tmp_path, processes):
+    malformed_diagrams(str(tmp_path))
+    output = str(tmp_path / 'modes')
+    entries = module.DiagramBatch(str(tmp_path), 'walk', processes=processes).run(output)
+    errors = dict((os.path.basename(entry['diagram']), entry['error']) for entry in entries)
+    assert errors['uwcse.mayukh'] is None
+    assert errors['style.mayukh'].startswith('Error [2]: ')
+    assert errors['unparsable.mayukh'].startswith('Error [1]: Could not parse the diagram (IndexError')
+    assert errors['short.mayukh'].startswith('Error [1]: File opened successfully, but has the wrong number')
+    assert read_modes(os.path.join(output, 'uwcse.txt'))[1:] == EXPECTED['uwcse.mayukh -w'][1:]
+    with open(os.path.join(output, 'index.json')) as f:
+        assert json.load(f)['diagrams'] == entries
+    assert sorted(os.listdir(output)) == ['index.json', 'uwcse.txt']
+
+def test_diagram_batch_raises_other_errors(tmp_path, monkeypatch):
+    malformed_diagrams(str(tmp_path))
+    def broken(*arguments):
+        raise TypeError('not a malformed diagram')
+    monkeypatch.setattr(module, 'write_modes', broken)
+    with pytest.raises(TypeError):
+        module.DiagramBatch(str(tmp_path / 'uwcse.mayukh'), 'walk', processes=1).run(str(tmp_path / 'modes'))
+
+def test_diagram_batch_gives_files_with_the_same_name_their_own_output(tmp_path):
+    for directory in ('a', 'b', 'c'):
+        (tmp_path / directory).mkdir()
+        write(str(tmp_path / directory / 'imdb.mayukh'), read_diagram('imdb.mayukh'))
+    entries = module.DiagramBatch(str(tmp_path / '*' / 'imdb.mayukh'), 'walk').run(str(tmp_path / 'modes'))
+    assert [os.path.basename(entry['output']) for entry in entries] == ['imdb.txt', 'imdb_2.txt', 'imdb_3.txt']
+    for entry in entries:
+        assert modes_of(read_text(entry['output'])) == EXPECTED['imdb.mayukh -w']
+
+def test_batch_exit_status(tmp_path):
+    output = str(tmp_path / 'modes')
+    run_walker(['-w', '--batch', os.path.join(ROOT, 'diagrams'), '--output-dir', output])
+    malformed_diagrams(str(tmp_path))
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        run_walker(['-w', '--batch', str(tmp_path), '--output-dir', output])
+    assert error.value.returncode == 1
+    assert 'Walked 1 of 4 diagrams, 3 failed' in error.value.output.decode('utf-8')
+
+# FeatureRanking
+
+def ranking_dataset(directory, folds=('train1', 'train2')):
+    '''For diagrams/imdb.mayukh: actor covers the positives, female_gender a negative, movie and genre one of each.'''
+    for fold in folds + ('test1',):
+        os.makedirs(os.path.join(directory, fold))
+        prefix = os.path.join(directory, fold, fold)
+        write(prefix + '_pos.txt', 'workedunder(p1,p2).\nworkedunder(p3,p4).\n')
+        write(prefix + '_neg.txt', 'workedunder(p5,p6).\nworkedunder(p7,p8).\n')
+        if fold.startswith('test'):
+            # Never read: it would make female_gender cover every example.
+            write(prefix + '_facts.txt', ''.join('female_gender(p' + str(i) + ').\n' for i in range(1, 9)))
+        else:
+            write(prefix + '_facts.txt', 'actor(p1).\nactor(p3).\nfemale_gender(p5).\nmovie(m1,p1).\n'
+                                         'movie(m1,p5).\ngenre(m1,g1).\nworkedunder(p1,p2).\n')
+    return directory
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_feature_ranking_by_information_gain(tmp_path, processes):
+    dictionaries = BuildDictionaries(read_diagram('imdb.mayukh'))
+    ranking = module.FeatureRanking(dictionaries, ranking_dataset(str(tmp_path)), processes=processes)
+    positives, negatives, totals = ranking.statistics()
+    assert (positives, negatives) == (4, 4)
+    assert totals['actor'] == [4, 4, 0]
+    assert totals['female_gender'] == [2, 0, 2]
+    # genre(m1, g1) covers the examples that m1 is linked to by movie facts.
+    assert totals['genre'] == [2, 2, 2]
+    assert 'workedunder' not in totals
+
+    ranked = ranking.rank()
+    assert [feature for feature, gain, coverage in ranked] == ['actor', 'female_gender', 'genre', 'movie']
+    gains = dict((feature, (round(gain, 4), coverage)) for feature, gain, coverage in ranked)
+    assert gains == {'actor': (1.0, 0.5), 'female_gender': (0.3113, 0.25), 'genre': (0.0, 0.5), 'movie': (0.0, 0.5)}
+    assert dictionaries.importants == ['actor', 'genre', 'female_gender', 'movie']
+    assert ranking.apply() == ranked
+    assert dictionaries.importants == ['actor', 'female_gender', 'genre', 'movie']
+
+def test_feature_ranking_refuses_datasets_without_examples(tmp_path):
+    dictionaries = BuildDictionaries(read_diagram('imdb.mayukh'))
+    with pytest.raises(module.ExceptionCase):
+        module.FeatureRanking(dictionaries, str(tmp_path / 'missing'))
+    with pytest.raises(module.ExceptionCase):
+        module.FeatureRanking(dictionaries, make_dataset(str(tmp_path / 'test_only'), folds=('test1',)))
+    with pytest.raises(module.ExceptionCase):
+        module.FeatureRanking(dictionaries, ranking_dataset(str(tmp_path / 'other')), target='movie').rank()
+
+def test_rank_features_from_the_command_line(tmp_path):
+    output = run_walker(['-s', '--number', '2', '--rank-features', ranking_dataset(str(tmp_path)),
+                         'diagrams/imdb.mayukh'])
+    assert [line for line in output.splitlines() if line.startswith('// ')] == [
+        '// 1.0000 0.500 actor', '// 0.3113 0.250 female_gender', '// 0.0000 0.500 genre', '// 0.0000 0.500 movie']
+    assert modes_of(output)[1:] == walker(read_diagram('imdb.mayukh')).shortest(features=['actor', 'female_gender'])
@@ -5,13 +5,28 @@ usage: walker.py [-h] [-v] [--number NUMBER] [-w | -s | -n | -e | -r | -rw ] dia
 
 from __future__ import print_function
 from collections import OrderedDict
+from contextlib import contextmanager
+from array import array
 import argparse
+import functools
+import glob
+import gzip
+import hashlib
+import io
 import itertools
 import json
+import math
+import mmap
+import multiprocessing
 #import networkx (if pagerank is implemented)
 import os
 import random
 import re
+import signal
+import struct
+import sys
+import tempfile
+import time
 
 # Define a short class for raising exceptions to help with debugging.
 
@@ -19,6 +34,118 @@ class ExceptionCase(Exception):
     def handle(self):
         print(self.message)
 
+# Stats: where a run spends its time, for --stats.
+
+@contextmanager
+def null_phase():
+    # Used in place of Stats.phase when nothing is recorded.
+    yield
+
+def timed(name):
+    '''Decorator for methods of objects with a stats attribute: the calls are recorded as the phase name.'''
+    def decorate(method):
+        @functools.wraps(method)
+        def timed_method(self, *args, **kwargs):
+            if self.stats is None:
+                return method(self, *args, **kwargs)
+            with self.stats.phase(name):
+                return method(self, *args, **kwargs)
+        return timed_method
+    return decorate
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: peak memory is not reported there.
+    resource = None
+
+# CPU time of this process (time.clock on Python 2).
+process_time = getattr(time, 'process_time', None) or time.clock
+
+class Stats:
+
+    def __init__(self):
+        self.phases = OrderedDict()   # name -> {'wall': seconds, 'cpu': seconds, 'calls': n}
+        self.counters = OrderedDict() # name -> number, or {name: number}
+        self.worker_peak_kb = None    # The largest peak memory of the merged worker stats.
+
+    @contextmanager
+    def phase(self, name):
+        '''Time a block; phases with the same name add up.'''
+        wall = time.time()
+        cpu = process_time()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            phase['wall'] += time.time() - wall
+            phase['cpu'] += process_time() - cpu
+            phase['calls'] += 1
+
+    def count(self, name, number=1, key=None):
+        if key is None:
+            self.counters[name] = self.counters.get(name, 0) + number
+        else:
+            counter = self.counters.setdefault(name, OrderedDict())
+            counter[key] = counter.get(key, 0) + number
+
+    def peak_memory_kb(self):
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            # Bytes on macOS, kilobytes everywhere else.
+            peak //= 1024
+        return peak
+
+    def merge(self, other, prefix=None):
+        '''
+        Add the phases and counters of another Stats.as_dict(), e.g. from a worker process, to these. With prefix
+        (e.g. the name of a diagram), keyed counters are kept apart under prefix|key instead of being added up.
+        '''
+        for name, phase in other['phases'].items():
+            totals = self.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            for field in totals:
+                totals[field] += phase[field]
+        for name, counter in other['counters'].items():
+            if isinstance(counter, dict):
+                for key, number in counter.items():
+                    self.count(name, number, key if prefix is None else prefix + '|' + key)
+            else:
+                self.count(name, counter)
+        if other['peak_memory_kb'] is not None:
+            self.worker_peak_kb = max(self.worker_peak_kb or 0, other['peak_memory_kb'])
+
+    def as_dict(self):
+        '''The peak memory is that of the largest process, this one or a worker whose stats were merged.'''
+        peak = self.peak_memory_kb()
+        if self.worker_peak_kb is not None:
+            peak = max(peak or 0, self.worker_peak_kb)
+        return OrderedDict([('phases', self.phases), ('counters', self.counters), ('peak_memory_kb', peak)])
+
+    def report(self, started, filename=None):
+        '''Add the 'total' phase since started (wall and CPU time), then write the JSON to filename or print it.'''
+        self.phases['total'] = {'wall': time.time() - started[0], 'cpu': process_time() - started[1], 'calls': 1}
+        if filename:
+            write_file_atomically(filename, self.to_json() + '\n')
+        else:
+            print('//stats:', self.to_json())
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), sort_keys=False)
+
+def read_diagram(filename):
+    '''Reads the contents of the diagram file 'filename', raises an exception if it cannot be read or is not 6 lines.'''
+    if not os.path.isfile(filename):
+        raise ExceptionCase('Error [1]: Could not find file: "' + filename + '"')
+    try:
+        diagram = open(filename).read()
+    except:
+        raise ExceptionCase('Error [1]: Could not read the file: "' + filename + '"')
+    if (len(diagram.splitlines()) != 6):
+        raise ExceptionCase('Error [1]: File opened successfully, but has the wrong number of lines.')
+    return diagram
+
 # Setup: parse the commandline input, perform checks, and import/parse the specified file.
 
 class Setup:
@@ -34,6 +161,32 @@ class Setup:
         self.random = False      # -r, --random
         self.randomwalk = False  # -rw, --randomwalk
         self.Nfeatures = None    # -n, --number
+        self.cache_dir = None    # --cache, --cache-dir
+        self.cache_size = 64     # --cache-size
+        self.targets = None      # --all-targets (every candidate), --targets
+        self.output_dir = 'modes' # --output-dir
+        self.processes = None    # --processes
+        self.mode = 'walk'       # Name of the walking mode, as used by the walker class.
+        self.seed = None         # --seed
+        self.walks = 1           # --walks
+        self.threshold = 0.5     # --threshold
+        self.window = None       # --window
+        self.max_depth = None    # --max-depth
+        self.max_paths = None    # --max-paths-per-feature
+        self.time_budget = None  # --time-budget
+        self.sweep = False       # --sweep
+        self.samples = None      # --samples
+        self.write_bk = None     # --write-bk
+        self.settings = None     # --set-param
+        self.negatives_dir = None # --sample-negatives
+        self.rank_dir = None     # --rank-features
+        self.facts_file = None   # --facts
+        self.benchmark = None    # --benchmark
+        self.stats = None        # --stats, --stats-file
+        self.serve = None        # --serve
+        self.batch = None        # --batch
+        self.update_baseline = False # --update-baseline
+        self.ratio = 3.0         # --ratio
         
         # Start by creating an argument parser to help with user input.
         parser = argparse.ArgumentParser(description="Walk-ER: a system for walking the paths in an entity-relational diagram."\
@@ -45,7 +198,7 @@ class Setup:
                                          " There is NO WARRANTY, to the extent permitted by law.")
         # Add the arguments.
         walk = parser.add_mutually_exclusive_group()
-        parser.add_argument("diagram_file")
+        parser.add_argument("diagram_file", nargs='?')
         parser.add_argument("-v", "--verbose",
                             help="Increase verbosity to help with debugging.", 
                             action="store_true")
@@ -53,6 +206,101 @@ class Setup:
                             type=int,
                             help="Select number of features to walk to (assumes that Important features are ordered from most important to least important). Defaults to number_attributes + number_relations if chosen number is greater than both.")
         #parser.add_argument('Nfeatures')
+        parser.add_argument("--seed",
+                            type=int,
+                            help="Seed the random number generator used by -r and -rw.")
+        parser.add_argument("--walks",
+                            type=int,
+                            default=1,
+                            help="With -rw: run this many random walks and keep the modes produced by at least --threshold of them.")
+        parser.add_argument("--threshold",
+                            type=float,
+                            default=0.5,
+                            help="With -rw --walks: fraction of the walks that must produce a mode for it to be kept (default: 0.5).")
+        parser.add_argument("--window",
+                            type=int,
+                            help="With -rw: stop each walk after this many steps in a row without a new mode.")
+        parser.add_argument("--max-depth",
+                            type=int,
+                            help="With -w/-s/-e/-r: do not walk paths longer than this many edges.")
+        parser.add_argument("--max-paths-per-feature",
+                            type=int,
+                            help="With -w/-s/-e/-r: keep at most this many paths to each feature, shortest first.")
+        parser.add_argument("--time-budget",
+                            type=float,
+                            metavar='SECONDS',
+                            help="With -w/-s/-e/-r: stop walking after this many seconds and use the paths found so far.")
+        targets = parser.add_mutually_exclusive_group()
+        targets.add_argument("--all-targets",
+                             help="Produce modes for every relation and attribute as the target, one file per target in --output-dir.",
+                             action="store_true")
+        targets.add_argument("--targets",
+                             metavar='T1,T2,...',
+                             help="Like --all-targets, for a comma-separated list of targets.")
+        parser.add_argument("--batch",
+                            metavar='DIR_OR_GLOB',
+                            help="Instead of one diagram_file, walk every diagram matched by DIR_OR_GLOB (a directory means DIR/*.mayukh) in parallel: one file per diagram and index.json in --output-dir.")
+        parser.add_argument("--output-dir",
+                            default='modes',
+                            help="Directory for the files written by --all-targets/--targets, --sweep and --batch (default: modes).")
+        parser.add_argument("--samples",
+                            type=int,
+                            metavar='K',
+                            help="With -r: draw K random feature subsets (repeatable with --seed) and write one file per distinct mode set, plus manifest.json, in --output-dir.")
+        parser.add_argument("--write-bk",
+                            metavar='DATASET_DIR',
+                            help="Write the modes to DATASET_DIR/<name>_bk.txt (name is the last part of DATASET_DIR) and point every fold's <fold>_bk.txt at it. With --batch, DATASET_DIR holds one dataset per diagram: <diagram>.mayukh goes to DATASET_DIR/<diagram>.")
+        parser.add_argument("--set-param",
+                            metavar='NAME=VALUE',
+                            action='append',
+                            help="With --write-bk: a setParam line for the background file, can be repeated (default: treeDepth=3 and nodeSize=3).")
+        parser.add_argument("--sample-negatives",
+                            metavar='DATASET_DIR',
+                            help="Instead of walking, write negative examples of the target (or of a single --targets target) to <fold>_neg.txt in every fold of DATASET_DIR (repeatable with --seed).")
+        parser.add_argument("--rank-features",
+                            metavar='DATASET_DIR',
+                            help="Reorder the Important features (which --number counts from) by how well their facts separate the positive and negative examples of the target (or of a single --targets target) in the train folds of DATASET_DIR.")
+        parser.add_argument("--facts",
+                            metavar='FACTS_FILE',
+                            help="Instead of walking, summarize FACTS_FILE (stored as FACTS_FILE.store for later runs) and check it against the diagram.")
+        parser.add_argument("--stats",
+                            help="Record the time spent in each phase, search counters and peak memory, as JSON: a '//stats:' line after the modes.",
+                            action="store_true")
+        parser.add_argument("--stats-file",
+                            metavar='FILE',
+                            help="Like --stats, but write the JSON to FILE.")
+        parser.add_argument("--serve",
+                            nargs='?',
+                            const='127.0.0.1:8765',
+                            metavar='ADDRESS',
+                            help="Run as a server answering JSON mode requests on ADDRESS, host:port or a Unix socket path (default: 127.0.0.1:8765). Python 3 only.")
+        parser.add_argument("--benchmark",
+                            metavar='BASELINE_JSON',
+                            help="Instead of walking a diagram, time every mode on generated diagrams and fail if one is slower than BASELINE_JSON (written if it does not exist).")
+        parser.add_argument("--update-baseline",
+                            help="With --benchmark: overwrite BASELINE_JSON with this run.",
+                            action="store_true")
+        parser.add_argument("--ratio",
+                            type=float,
+                            default=3.0,
+                            help="With --sample-negatives: number of negatives per positive example (default: 3).")
+        parser.add_argument("--sweep",
+                            help="With -w/-s: write the modes for the first 1, 2, ... --number Important features, one file per number in --output-dir.",
+                            action="store_true")
+        parser.add_argument("--processes",
+                            type=int,
+                            help="Number of worker processes for batch runs (default: one per CPU).")
+        parser.add_argument("--cache",
+                            help="Reuse parsed diagrams and walked paths between runs, stored in ~/.cache/walker (see --cache-dir).",
+                            action="store_true")
+        parser.add_argument("--cache-dir",
+                            metavar='DIR',
+                            help="Like --cache, but store the cache in DIR.")
+        parser.add_argument("--cache-size",
+                            type=int,
+                            default=64,
+                            metavar='MB',
+                            help="Remove the least recently used cache entries when the cache grows past this size (default: 64).")
         walk.add_argument("-w", "--walk",
                           help="[Default] Walk graph from target to features.", 
                           action="store_true")
@@ -60,7 +308,7 @@ class Setup:
                           help="Walk the graph from target to features. If there are multiple paths, take the shortest. If the shortest are equal lengths, walk both.",
                           action="store_true")
         walk.add_argument("-n", "--nowalk",
-                          help="[Not implemented] Instantiate variables without walking.", 
+                          help="Instantiate the predicates from the breadth-first layers around the target, without enumerating paths (the modes of -s over every feature).",
                           action="store_true")
         walk.add_argument("-e", "--exhaustive",
                           help="Walk graph from every feature to every feature.",
@@ -75,24 +323,54 @@ class Setup:
         # Get the args.
         args = parser.parse_args()
 
-        # Make sure the diagram_file is valid.
-        if not os.path.isfile(args.diagram_file):
-            raise ExceptionCase('Error [1]: Could not find file: "' + args.diagram_file + '"')
-
-        # Import the file:
-        '''Reads the contents of 'file_to_read', raises an exception if it cannot be read.'''
-        try:
-            diagram = open(args.diagram_file).read()
-        except:
-            raise ExceptionCase('Error [1]: Could not read the file: "' + args.diagram_file + '"')
-        
-        if (len(diagram.splitlines()) == 6):
-            self.diagram_file = diagram
+        if (args.serve != None):
+            # Diagrams come with the requests.
+            self.serve = args.serve
+            self.verbose = args.verbose
+            if (args.processes != None) and (args.processes < 1):
+                raise(ExceptionCase('Error [1]: Need at least one process.'))
+            self.processes = args.processes
+            return
+
+        if (args.benchmark != None):
+            # Benchmarks generate their own diagrams.
+            self.benchmark = args.benchmark
+            self.update_baseline = args.update_baseline
+            self.verbose = args.verbose
+            return
+
+        if (args.batch != None):
+            # Each diagram is read by the worker that walks it, so a malformed one does not stop the others.
+            if (args.diagram_file != None):
+                raise ExceptionCase('Error [1]: Give either a diagram_file or --batch, not both.')
+            for option in ['all_targets', 'targets', 'sweep', 'samples', 'sample_negatives', 'facts', 'rank_features']:
+                if getattr(args, option) not in (None, False):
+                    raise ExceptionCase('Error [1]: --' + option.replace('_', '-') + ' does not work with --batch.')
+            self.batch = args.batch
+            diagram = None
         else:
-            raise ExceptionCase('Error [1]: File opened successfully, but has the wrong number of lines.')
-            
+            # Make sure the diagram_file is valid, then import it.
+            if (args.diagram_file == None):
+                raise ExceptionCase('Error [1]: No diagram file was given.')
+            diagram = read_diagram(args.diagram_file)
+            self.diagram_file = diagram
+
         # Since the files exist, we can go ahead and set the rest of the parameters, starting with verbose
         self.verbose = args.verbose
+        if (args.stats_file != None):
+            self.stats = args.stats_file
+        elif args.stats:
+            # An empty string means the stats are printed.
+            self.stats = ''
+
+        if (args.cache_dir != None):
+            self.cache_dir = args.cache_dir
+        elif args.cache:
+            # An empty string means the default directory.
+            self.cache_dir = ''
+        if (args.cache_size <= 0):
+            raise(ExceptionCase('Error [1]: The cache size must be positive.'))
+        self.cache_size = args.cache_size
         
         if (args.number != None):
             if (args.number >= 0):
@@ -112,16 +390,98 @@ class Setup:
             self.exhaustive = args.exhaustive
             self.random = args.random
             self.randomwalk = args.randomwalk
+
+        for mode in ['shortest', 'exhaustive', 'random', 'randomwalk', 'nowalk']:
+            if getattr(self, mode):
+                self.mode = mode
+
+        if args.all_targets:
+            self.targets = []
+        elif (args.targets != None):
+            self.targets = [target.strip() for target in args.targets.split(',') if target.strip()]
+            if not self.targets:
+                raise(ExceptionCase('Error [1]: --targets needs at least one target.'))
+        self.output_dir = args.output_dir
+        if args.sweep and not (self.mode in ('walk', 'shortest') and self.targets == None):
+            raise(ExceptionCase('Error [1]: --sweep only works with -w or -s, for a single target.'))
+        self.sweep = args.sweep
+        if (args.samples != None):
+            if not (self.mode == 'random' and self.targets == None):
+                raise(ExceptionCase('Error [1]: --samples only works with -r, for a single target.'))
+            if (args.samples < 1):
+                raise(ExceptionCase('Error [1]: Need at least one sample.'))
+        self.samples = args.samples
+        if (args.write_bk != None):
+            if (self.targets != None) or (self.samples != None):
+                raise(ExceptionCase('Error [1]: --write-bk writes the modes for a single target.'))
+            for option in ['sweep', 'sample_negatives', 'facts']:
+                if getattr(args, option) not in (None, False):
+                    raise ExceptionCase('Error [1]: --' + option.replace('_', '-') + ' does not produce the modes --write-bk writes.')
+            if not os.path.isdir(args.write_bk):
+                raise(ExceptionCase('Error [1]: Dataset directory does not exist: "' + args.write_bk + '"'))
+        self.write_bk = args.write_bk
+        if (args.ratio < 0):
+            raise(ExceptionCase('Error [1]: The ratio of negatives to positives cannot be negative.'))
+        self.ratio = args.ratio
+        if (args.sample_negatives != None) and (self.targets != None) and (len(self.targets) != 1):
+            raise(ExceptionCase('Error [1]: --sample-negatives samples the examples of a single target.'))
+        self.negatives_dir = args.sample_negatives
+        if (args.rank_features != None):
+            if not os.path.isdir(args.rank_features):
+                raise(ExceptionCase('Error [1]: Dataset directory does not exist: "' + args.rank_features + '"'))
+            if (self.targets != None) and (len(self.targets) != 1):
+                # One ranking is for one target: the best features for one target say little about another.
+                raise(ExceptionCase('Error [1]: --rank-features ranks the features for a single target.'))
+        self.rank_dir = args.rank_features
+        if (args.facts != None) and not os.path.isfile(args.facts):
+            raise(ExceptionCase('Error [1]: Facts file does not exist: "' + args.facts + '"'))
+        self.facts_file = args.facts
+        if (args.set_param != None):
+            self.settings = []
+            for setting in args.set_param:
+                if '=' not in setting:
+                    raise(ExceptionCase('Error [1]: --set-param needs NAME=VALUE: "' + setting + '"'))
+                self.settings.append(tuple(part.strip() for part in setting.split('=', 1)))
+        self.seed = args.seed
+        if (args.walks < 1):
+            raise(ExceptionCase('Error [1]: Need at least one walk.'))
+        self.walks = args.walks
+        if not (0.0 <= args.threshold <= 1.0):
+            raise(ExceptionCase('Error [1]: The threshold is a fraction between 0 and 1.'))
+        self.threshold = args.threshold
+        if (args.window != None) and (args.window < 1):
+            raise(ExceptionCase('Error [1]: The window is at least one step.'))
+        self.window = args.window
+        if (args.max_depth != None) and (args.max_depth < 0):
+            raise(ExceptionCase('Error [1]: Cannot have a negative depth.'))
+        self.max_depth = args.max_depth
+        if (args.max_paths_per_feature != None) and (args.max_paths_per_feature < 1):
+            raise(ExceptionCase('Error [1]: Need at least one path per feature.'))
+        self.max_paths = args.max_paths_per_feature
+        if (args.time_budget != None) and (args.time_budget <= 0):
+            raise(ExceptionCase('Error [1]: The time budget must be positive.'))
+        self.time_budget = args.time_budget
+        # The same budgets as the max_depth, max_paths and time_budget keywords of Networks and the walker class.
+        self.budgets = {'max_depth': self.max_depth, 'max_paths': self.max_paths, 'time_budget': self.time_budget}
+        if (args.processes != None) and (args.processes < 1):
+            raise(ExceptionCase('Error [1]: Need at least one process.'))
+        self.processes = args.processes
         
-        if self.verbose:
+        if self.verbose and (diagram != None):
             print('Imported Diagram File:\n')
             print(diagram)
 
 class BuildDictionaries:
 
-    def __init__(self, diagram, verbose=False):
+    # Everything parse() produces, stored by DiagramCache.
+    compiled_fields = ['entities', 'relations', 'attributes', 'Graph', 'relations_dict',
+                       'attribute_dict', 'multi_value_attributes', 'importants', 'target']
+
+    def __init__(self, diagram, verbose=False, cache=None, stats=None):
         self.verbose = verbose
         self.diagram = diagram
+        self.cache = cache
+        self.stats = stats # A Stats, shared with the Networks built from these dictionaries.
         '''Takes the diagram file passed as an input and turns it into dictionaries that can be used over the next few sections:
         Nodes: {Student=EntityNodeStyle, Professor=EntityNodeStyle, Rating=AttributeNodeStyle, Teach=RelationNodeStyle}
         Edges : {publish|paper=RelationEdge, Course|Rating=AttributeEdge}
@@ -139,7 +499,42 @@ class BuildDictionaries:
         self.relations_dict = {}
         self.attribute_dict = {}
         self.multi_value_attributes = {}
-        
+
+        with self.phase('parse'):
+            # Reuse the compiled diagram if this exact file was parsed before.
+            compiled = None
+            if self.cache is not None:
+                compiled = self.cache.load(self.diagram)
+            if compiled is not None:
+                for field in self.compiled_fields:
+                    setattr(self, field, compiled['dictionaries'][field])
+            else:
+                self.parse()
+                if self.cache is not None:
+                    self.cache.store(self.diagram, dict((field, getattr(self, field, None)) for field in self.compiled_fields))
+
+        with self.phase('index'):
+            # Intern the graph for the walkers, then precompute the pruning index used when enumerating paths.
+            self.compact_graph = CompactGraph(self.Graph, self.entities, self.relations, self.attributes)
+            self.block_cut_tree = BlockCutTree(self.compact_graph)
+
+        if self.verbose:
+            if compiled is not None:
+                print('Loaded compiled diagram from the cache.')
+            print('Entities:', self.entities)
+            print('Graph:', self.Graph)
+            print('Relations:', self.relations_dict)
+            print('Attributes:', self.attribute_dict)
+            print('Multi-Value Attributes:', self.multi_value_attributes)
+            print('Important:', self.importants)
+            print('Target:', self.target)
+
+    def phase(self, name):
+        if self.stats is None:
+            return null_phase()
+        return self.stats.phase(name)
+
+    def parse(self):
         for line in self.diagram.splitlines():
 
             # First line: all nodes in the graph: {Student=EntityNodeStyle, Rating=AttributeNodeStyle, Teach=RelationNodeStyle}
@@ -156,7 +551,6 @@ class BuildDictionaries:
                     elif current[1] == 'RelationNodeStyle':
                         self.relations.append(current[0])
                     else:
-                        print(curren)
                         raise ExceptionCase('Error [2]: During BuildDictionaries/parse, found something that was not an entity, relation, or attribute.')
                     
             # Second: all edges between nodes: {publish|paper=RelationEdge, Course|Rating=AttributeEdge}
@@ -244,19 +638,285 @@ class BuildDictionaries:
                 
             else:
                 raise ExceptionCase('Error: did not recognize an item in the diagram file: ' + str(line))
-            
-        if self.verbose:
-            print('Entities:', self.entities)
-            print('Graph:', self.Graph)
-            print('Relations:', self.relations_dict)
-            print('Attributes:', self.attribute_dict)
-            print('Multi-Value Attributes:', self.multi_value_attributes)
-            print('Important:', self.importants)
-            print('Target:', self.target)
+
+# DiagramCache: compiled diagrams and their target-to-feature paths, kept on disk between runs.
+
+class DiagramCache:
+
+    version = 1
+
+    def __init__(self, directory=None, max_bytes=64 * 1024 * 1024):
+        '''
+        Each diagram is stored as one gzipped JSON file named after a hash of its contents, so editing the
+        diagram file automatically misses the old entry. When the directory grows past max_bytes, the least
+        recently used entries are removed.
+        '''
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache', 'walker')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = {} # Entries that were already read or written by this process.
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                raise ExceptionCase('Error [1]: Could not create the cache directory: "' + self.directory + '"')
+
+    def key(self, diagram):
+        return hashlib.sha1((str(self.version) + '\n' + diagram).encode('utf-8')).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + '.json.gz')
+
+    def entry(self, diagram):
+        key = self.key(diagram)
+        if key not in self.entries:
+            filename = self.filename(key)
+            try:
+                with gzip.open(filename, 'rb') as f:
+                    self.entries[key] = json.loads(f.read().decode('utf-8'))
+                # Touch the file so eviction sees that it was used.
+                os.utime(filename, None)
+            except (IOError, OSError, ValueError):
+                # Missing or unreadable: start over.
+                return None
+        return self.entries[key]
+
+    def load(self, diagram):
+        '''Returns the compiled entry for diagram, or None if it has not been cached.'''
+        return self.entry(diagram)
+
+    def store(self, diagram, dictionaries):
+        key = self.key(diagram)
+        self.entries[key] = {'dictionaries': dictionaries, 'names': [], 'paths': {}}
+        self.write(key)
+
+    def load_paths(self, diagram, target, feature):
+        '''Returns the cached paths from target to feature as lists of names, or None.'''
+        entry = self.entry(diagram)
+        if entry is None:
+            return None
+        paths = entry['paths'].get(target + '|' + feature)
+        if paths is None:
+            return None
+        names = entry['names']
+        return [[names[node] for node in path] for path in paths]
+
+    def store_paths(self, diagram, paths):
+        '''paths maps (target, feature) to lists of paths of node names. Names are written once, paths as indices.'''
+        entry = self.entry(diagram)
+        if entry is None:
+            return
+        names = entry['names']
+        ids = dict((name, i) for i, name in enumerate(names))
+        for (target, feature), feature_paths in paths.items():
+            compiled = []
+            for path in feature_paths:
+                for name in path:
+                    if name not in ids:
+                        ids[name] = len(names)
+                        names.append(name)
+                compiled.append([ids[name] for name in path])
+            entry['paths'][target + '|' + feature] = compiled
+        self.write(self.key(diagram))
+
+    def write(self, key):
+        data = io.BytesIO()
+        with gzip.GzipFile(fileobj=data, mode='wb') as f:
+            f.write(json.dumps(self.entries[key], separators=(',', ':')).encode('utf-8'))
+        try:
+            # Other runs may read the entry at any time.
+            write_file_atomically(self.filename(key), data.getvalue(), binary=True)
+        except (IOError, OSError):
+            # The cache is only an optimization.
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json.gz'):
+                filename = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.path.getmtime(filename), os.path.getsize(filename), filename))
+                except OSError:
+                    continue
+        total = sum(size for _, size, _ in entries)
+        # Oldest first.
+        for _, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+# CompactGraph: the diagram with node names interned to dense integers and CSR-style adjacency.
+
+class CompactGraph:
+
+    ENTITY = 0
+    RELATION = 1
+    ATTRIBUTE = 2
+    OTHER = 3 # Named by an edge, the target or a feature, but not declared in Nodes.
+
+    def __init__(self, graph, entities, relations, attributes):
+        '''
+        Node i is called names[i], its neighbors are adjacency[offsets[i]:offsets[i + 1]] and its style is kinds[i].
+        The walkers only deal with these integers, names are looked up again when the modes are written.
+        '''
+        self.names = []
+        self.ids = {}
+        self.kinds = array('b')
+
+        for kind, nodes in ((self.ENTITY, entities), (self.RELATION, relations), (self.ATTRIBUTE, attributes)):
+            for name in nodes:
+                if name not in self.ids:
+                    self.add_name(name, kind)
+        for name in graph:
+            if name not in self.ids:
+                self.add_name(name, self.OTHER)
+
+        self.offsets = array('i', [0])
+        self.adjacency = array('i')
+        for name in self.names:
+            self.adjacency.extend(self.ids[neighbor] for neighbor in graph.get(name, []))
+            self.offsets.append(len(self.adjacency))
+
+    def add_name(self, name, kind):
+        self.ids[name] = len(self.names)
+        self.names.append(name)
+        self.kinds.append(kind)
+
+    def intern(self, name):
+        '''Returns the id of name, adding it as a node without any edges if the diagram did not mention it.'''
+        if name not in self.ids:
+            self.add_name(name, self.OTHER)
+            self.offsets.append(self.offsets[-1])
+        return self.ids[name]
+
+    def neighbors(self, node):
+        return self.adjacency[self.offsets[node]:self.offsets[node + 1]]
+
+    def __len__(self):
+        return len(self.names)
+
+# BlockCutTree: biconnected components of the diagram, used to prune walks that can never reach a feature.
+
+class BlockCutTree:
+
+    def __init__(self, graph):
+        '''
+        Split the (undirected) CompactGraph into biconnected blocks with an iterative version of Tarjan's algorithm.
+        A node lies on some simple path from start to end exactly when it belongs to one of the blocks on the
+        path between start and end in the block-cut tree, which is what relevant() returns.
+        '''
+        self.blocks = []        # List of sets of nodes.
+        self.node_blocks = {}   # node -> indices of the blocks it belongs to.
+        self.relevant_cache = {}
+
+        # Parallel edges (e.g. Person|sameperson and sameperson|Person) do not matter for simple paths.
+        neighbors = [list(OrderedDict.fromkeys(graph.neighbors(node))) for node in range(len(graph))]
+
+        index = [-1] * len(graph)
+        low = [-1] * len(graph)
+        counter = 0
+        for root in range(len(graph)):
+            if index[root] >= 0 or not neighbors[root]:
+                continue
+            index[root] = low[root] = counter
+            counter += 1
+            visited = [root]
+            stack = [(root, None, iter(neighbors[root]))]
+
+            while stack:
+                node, parent, remaining = stack[-1]
+                for child in remaining:
+                    if child == parent:
+                        continue
+                    if index[child] >= 0:
+                        low[node] = min(low[node], index[child])
+                    else:
+                        index[child] = low[child] = counter
+                        counter += 1
+                        visited.append(child)
+                        stack.append((child, node, iter(neighbors[child])))
+                        break
+                else:
+                    stack.pop()
+                    if not stack:
+                        continue
+                    parent = stack[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                    if low[node] >= index[parent]:
+                        # parent separates node's subtree from the rest: pop one block.
+                        block = set([parent])
+                        while True:
+                            member = visited.pop()
+                            block.add(member)
+                            if member == node:
+                                break
+                        self.blocks.append(block)
+
+        for i, block in enumerate(self.blocks):
+            for node in block:
+                self.node_blocks.setdefault(node, []).append(i)
+
+    def tree_node(self, node):
+        # Cut vertices are nodes of the block-cut tree themselves, everything else is represented by its block.
+        blocks = self.node_blocks[node]
+        if len(blocks) > 1:
+            return ('cut', node)
+        return ('block', blocks[0])
+
+    def tree_neighbors(self, tree_node):
+        kind, value = tree_node
+        if kind == 'cut':
+            return [('block', i) for i in self.node_blocks[value]]
+        return [('cut', node) for node in self.blocks[value] if len(self.node_blocks[node]) > 1]
+
+    def relevant(self, start, end):
+        '''Returns the set of nodes that appear on at least one simple path from start to end.'''
+        key = (start, end)
+        if key in self.relevant_cache:
+            return self.relevant_cache[key]
+
+        if start == end:
+            nodes = set([start])
+        elif start not in self.node_blocks or end not in self.node_blocks:
+            nodes = set()
+        else:
+            # Breadth-first search through the block-cut tree, then collect the blocks along the path.
+            source = self.tree_node(start)
+            goal = self.tree_node(end)
+            parents = {source: None}
+            frontier = [source]
+            while frontier and goal not in parents:
+                next_frontier = []
+                for tree_node in frontier:
+                    for neighbor in self.tree_neighbors(tree_node):
+                        if neighbor not in parents:
+                            parents[neighbor] = tree_node
+                            next_frontier.append(neighbor)
+                frontier = next_frontier
+
+            nodes = set()
+            if goal in parents:
+                nodes.update([start, end])
+                tree_node = goal
+                while tree_node is not None:
+                    if tree_node[0] == 'block':
+                        nodes.update(self.blocks[tree_node[1]])
+                    tree_node = parents[tree_node]
+
+        self.relevant_cache[key] = nodes
+        return nodes
 
 class Networks:
-    
-    def __init__(self, target, features, dictionaries, verbose=False):
+
+    def __init__(self, target, features, dictionaries, verbose=False, max_depth=None, max_paths=None, time_budget=None):
         self.verbose = verbose
         self.entities = dictionaries.entities
         self.relations = dictionaries.relations
@@ -267,43 +927,206 @@ class Networks:
         self.Graph = dictionaries.Graph
         self.relations_dict = dictionaries.relations_dict
         self.attribute_dict = dictionaries.attribute_dict
+        self.block_cut_tree = dictionaries.block_cut_tree
+        self.diagram = dictionaries.diagram
+        self.cache = dictionaries.cache
+
+        # Walkers run on the interned graph: the target and features become node ids.
+        self.graph = dictionaries.compact_graph
+        self.names = self.graph.names
+        self.target_id = self.graph.intern(target)
+        self.feature_ids = [self.graph.intern(feature) for feature in features]
+        self.pruned = 0 # Number of nodes skipped because they cannot lead to a feature.
+        self.calls = 0 # Descents into a node while enumerating paths (the calls of a recursive search).
+        self.nodes_visited = 0 # Neighbors examined while enumerating paths.
+        self.deepening_passes = 0 # Traversals run by bounded_paths_to_features, one per path length.
+        self.repeated_calls = 0 # Calls of those traversals that walked again what a shallower one had walked.
+        self.modes_generated = 0 # Modes added to final sets, before removing duplicates.
+        self.stats = getattr(dictionaries, 'stats', None)
+
+        # Budgets for walking paths: the longest path (in edges), the number of paths kept per feature and
+        # the number of seconds. budget_hit names the first one that ran out ('depth', 'paths' or 'time').
+        self.max_depth = max_depth
+        self.max_paths = max_paths
+        self.time_budget = time_budget
+        self.budget_hit = None
+        self.explored_depth = None # Length of the longest paths that were fully explored.
+        self.cut_off = False
         
         if self.verbose:
             print('\nWalk Mode:')
 
-    def find_all_paths(self, graph, start, end, path=[]):
-        # https://www.python.org/doc/essays/graphs/
-        path = path + [start]
-        if start == end:
-            return [path]
-        if start not in graph:
-            #if not graph.has_key(start):
-            return []
-        paths = []
-        for node in graph[start]:
-            if node not in path:
-                newpaths = self.find_all_paths(graph, node, end, path)
-                for newpath in newpaths:
-                    paths.append(newpath)
-        return paths
+    def find_paths_to_features(self, graph, start, ends, length=None, deadline=None):
+        '''
+        Enumerate the simple paths from start to every node in ends with a single traversal, iteratively: one
+        path stack is shared between all branches and visited nodes are tracked in a set. Yields (end, path)
+        pairs as soon as they are found; the paths for each end come out in the same order as the recursive
+        find_all_paths of https://www.python.org/doc/essays/graphs/ returned them.
+        With length, only the paths of exactly length edges are yielded and self.cut_off records whether
+        longer ones may exist. With deadline (a time.time() value) the traversal gives up once it has passed.
+        '''
+        ends = set(ends)
+        if not ends:
+            return
+        if start in ends:
+            # A path to the start itself stops there, exactly like the recursive recipe.
+            if not length:
+                yield start, [start]
+            ends.discard(start)
+
+        # Nodes that lie on some simple path to each feature, from the block-cut tree.
+        relevant = dict((end, self.block_cut_tree.relevant(start, end)) for end in ends)
 
-    def random_walk(self, graph, start, depth):
         path = [start]
+        visited = set(path)
+        stack = [iter(graph.neighbors(start))]
+        # Features that can still be reached from the current path without revisiting a node.
+        alive = [frozenset(end for end in ends if start in relevant[end])]
+        calls = 1
+        nodes = 0
 
-        # Randomly walk to nodes in the graph while length is less than maximum depth.
-        while len(path) < depth:
-            current_node = graph[start]
-            next_node = random.choice(current_node)
-            
-            path.append(next_node)
-            start = next_node
+        try:
+            while stack:
+                for node in stack[-1]:
+                    nodes += 1
+                    if node in visited:
+                        continue
+                    reachable = [end for end in alive[-1] if node in relevant[end]]
+                    if not reachable:
+                        self.pruned += 1
+                        continue
+                    if length is not None and len(path) > length:
+                        # Longer paths are left to the next, deeper traversal.
+                        self.cut_off = True
+                        continue
+                    if node in ends:
+                        if length is None or len(path) == length:
+                            yield node, path + [node]
+                        reachable.remove(node)
+                        if not reachable:
+                            continue
+                    if deadline is not None and time.time() > deadline:
+                        self.hit_budget('time')
+                        return
+                    # Keep walking past features: paths to other features may go through them.
+                    path.append(node)
+                    visited.add(node)
+                    stack.append(iter(graph.neighbors(node)))
+                    alive.append(frozenset(reachable))
+                    calls += 1
+                    break
+                else:
+                    stack.pop()
+                    alive.pop()
+                    visited.discard(path.pop())
+        finally:
+            self.calls += calls
+            self.nodes_visited += nodes
+
+    @timed('random_walk')
+    def random_walk(self, graph, start, depth, rng=random, window=None):
+        '''
+        Walk randomly from start for at most depth nodes (depth - 1 steps). The walk stops early once it has
+        produced every mode it could ever produce and visited every relation that changes the unexplored
+        modes (coverage), or after window steps in a row that changed nothing. Sets self.walk_steps and
+        self.walk_stop_reason ('depth', 'coverage' or 'window') and returns the number of steps taken.
+        '''
+        names = graph.names
+        final_set = set(self.random_walk_target_modes())
+
+        # Everything a walk from start can still contribute.
+        remaining_modes, remaining_visits = self.random_walk_coverage(graph, start)
+        remaining_modes -= final_set
 
         # If we walk to an entity, pop items off the stack and put the entity on the stack.
         # Instantiate -/+ based on what is currently on the stack.
         stack = []
-        final_set = []
+        last_entity = -1
+        seen_pairs = set()
+        visited = set()
+        steps = 0
+        quiet = 0
+        self.walk_stop_reason = 'depth'
+
+        # Randomly walk to nodes in the graph while length is less than maximum depth.
+        while steps < depth - 1:
+            if not remaining_modes and not remaining_visits:
+                self.walk_stop_reason = 'coverage'
+                break
+            if (window != None) and quiet >= window:
+                self.walk_stop_reason = 'window'
+                break
+
+            start = rng.choice(graph.neighbors(start))
+            steps += 1
+            quiet += 1
+
+            if start not in visited:
+                visited.add(start)
+                if start in remaining_visits:
+                    remaining_visits.discard(start)
+                    quiet = 0
+
+            kind = graph.kinds[start]
+            if kind == graph.ENTITY:
+                stack = [names[start]]
+                last_entity = start
+            elif kind == graph.RELATION and (start, last_entity) not in seen_pairs:
+                # The modes only depend on the relation and the entity on the stack.
+                seen_pairs.add((start, last_entity))
+                for mode in self.random_walk_relation_modes(names[start], stack):
+                    if mode not in final_set:
+                        final_set.add(mode)
+                        remaining_modes.discard(mode)
+                        quiet = 0
+            # I'm skipping attributes because they'll be instantiated with + regardless of whether they're explored or not.
+
+        final_set.update(self.random_walk_unexplored_modes(names[node] for node in visited))
+        self.walk_steps = steps
+        if self.stats is not None:
+            self.stats.count('walk_steps', steps)
+            self.stats.count('modes', len(final_set))
 
-        # Add the target to the final_set:
+        self.all_modes = ['mode: ' + element for element in sorted(final_set)]
+        self.all_modes_boostsrl = sorted(final_set)
+        #print('\n//background')
+        #print('//target is', target)
+        #for mode in self.all_modes:
+        #    print(mode)
+
+        return steps
+
+    def random_walk_coverage(self, graph, start):
+        '''
+        Explore the (node, entity on the stack) states a walk from start can reach. Returns the set of relation
+        modes those states produce, and the reachable nodes that are relations (visiting them removes their
+        unexplored '+' mode).
+        '''
+        names = graph.names
+        seen = set()
+        frontier = [(start, -1)]
+        while frontier:
+            node, last_entity = frontier.pop()
+            for neighbor in graph.neighbors(node):
+                state = (neighbor, neighbor if graph.kinds[neighbor] == graph.ENTITY else last_entity)
+                if state not in seen:
+                    seen.add(state)
+                    frontier.append(state)
+
+        modes = set()
+        visits = set()
+        for node, last_entity in seen:
+            if names[node] not in self.relations_dict:
+                continue
+            visits.add(node)
+            if graph.kinds[node] == graph.RELATION:
+                stack = [names[last_entity]] if last_entity >= 0 else []
+                modes.update(self.random_walk_relation_modes(names[node], stack))
+        return modes, visits
+
+    def random_walk_target_modes(self):
+        '''The target is instantiated with + everywhere.'''
+        final_set = []
         if self.target in self.attribute_dict:
             final_set.append(self.target + '(+' + self.attribute_dict[self.target] + ').')
         elif self.target in self.relations_dict:
@@ -312,89 +1135,700 @@ class Networks:
                 final_set.append(self.target + '(+' + self.relations_dict[self.target][0] + ',+' + self.relations_dict[self.target][0] + ').')
             else:
                 final_set.append(self.target + '(+' + ',+'.join(self.relations_dict[self.target]) + ').')
+        return final_set
 
-        # Handle everything that occurs after that target
-        path = path[1:]
-        for node in path:
-            if node in self.entities:
-                stack = [node]
-            elif node in self.relations:
-                out = []
-                if (len(self.relations_dict[node]) == 1):
-                    # Reflexive.
-                    out.append("+%s" % self.relations_dict[node][0])
-                    out.append("-%s" % self.relations_dict[node][0])
-                    final_set.append(node + '(' + ','.join(out) + ').')
-                    outrev = reversed(out)
-                    final_set.append(node + '(' + ','.join(outrev) + ').')
+    def random_walk_relation_modes(self, node, stack):
+        '''Modes for walking into the relation node while the entities in stack are instantiated.'''
+        final_set = []
+        out = []
+        if (len(self.relations_dict[node]) == 1):
+            # Reflexive.
+            out.append("+%s" % self.relations_dict[node][0])
+            out.append("-%s" % self.relations_dict[node][0])
+            final_set.append(node + '(' + ','.join(out) + ').')
+            outrev = reversed(out)
+            final_set.append(node + '(' + ','.join(outrev) + ').')
+        else:
+            # Not reflexive.
+            for var in self.relations_dict[node]:
+                if var in stack:
+                    out.append("+%s" % var)
                 else:
-                    # Not reflexive.
-                    for var in self.relations_dict[node]:
-                        if var in stack:
-                            out.append("+%s" % var)
-                        else:
-                            out.append("-%s" % var)
-                    final_set.append(node + '(' + ','.join(out) + ').')
-            # I'm skipping attributes because they'll be instantiated with + regardless of whether they're explored or not.
+                    out.append("-%s" % var)
+            final_set.append(node + '(' + ','.join(out) + ').')
+        return final_set
 
-        # Instantiate '+' for nodes that were not explored when walking.
-        unexplored = list((set(self.relations_dict.keys()) - set(path)).union(set(self.attribute_dict.keys())))
+    def random_walk_unexplored_modes(self, visited):
+        '''Instantiate '+' for nodes that were not explored when walking.'''
+        final_set = []
+        unexplored = list((set(self.relations_dict.keys()) - set(visited)).union(set(self.attribute_dict.keys())))
 
         for predicate in unexplored:
-            if predicate in self.attribute_dict:
-                
-                # Note: multivalued attributes need to be handled as #, while non-multivalued need nothing.
-                if predicate in self.multi_value_attributes:
-                    multi = ',#' + predicate.lower()
-                else:
-                    multi = ''
-
-                final_set.append(str(predicate +
-                                     '(+' + self.attribute_dict[predicate] + multi +
-                                     ').'))
-
-            elif predicate in self.relations_dict:
-                out = []
+            mode = self.unexplored_mode(predicate)
+            if mode is not None:
+                final_set.append(mode)
+        return final_set
 
-                variables = self.relations_dict[predicate]
-                # reverse the order of the variables for correct predicate logic format:
-                #variables = list(reversed(variables))
-                
-                for var in variables:
-                    out.append("+%s" % var)
-                    # A small fix for reflexive relationships:
-                    if len(variables) == 1:
-                        out.append("+%s" % var)
-                final_set.append(str(predicate + '(' + ','.join(out) + ').'))
-
-        self.all_modes = ['mode: ' + element for element in sorted(list(set(final_set)))]
-        #print('\n//background')
-        #print('//target is', target)
-        #for mode in self.all_modes:
-        #    print(mode)
+    @timed('random_walk')
+    def random_walk_ensemble(self, graph, start, depth, walks, seed=None, threshold=0.5, window=None):
+        '''
+        Run many random walks from start at once and keep the modes produced by at least threshold of them.
+        With numpy, the next node of every walker is sampled in one batch per step from the CompactGraph
+        arrays (the transition table); otherwise the walkers are stepped in a loop. Both draw one number per
+        walker and step from random.Random(seed), in the same order, so a seed gives the same walks either way.
+        Each walk stops early like random_walk does: on coverage, or after window steps without a new mode.
+        self.mode_frequencies maps each mode to the fraction of walks that produced it, self.walk_steps is the
+        number of steps of all the walks and self.walk_stop_reasons counts the walks by their stop reason.
+        '''
+        if walks < 1:
+            raise ExceptionCase('Error [1]: Need at least one walk.')
+        if depth > 1 and graph.offsets[start + 1] == graph.offsets[start]:
+            raise ExceptionCase('Error [3]: Cannot walk from "' + graph.names[start] + '", it has no edges.')
 
-        return path
-            
+        # numpy is optional, and only imported here so the other modes do not pay for it.
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        names = graph.names
+        target_modes = set(self.random_walk_target_modes())
+
+        # What a walk still has to do before it cannot change its modes any more (see random_walk): the modes
+        # of each (relation, entity on the stack) pair, numbered, and the relations whose visit removes a mode.
+        goal_modes, goal_visits = self.random_walk_coverage(graph, start)
+        goal_modes = dict((mode, i) for i, mode in enumerate(sorted(goal_modes - target_modes)))
+        pair_modes = {}
+        entities = [-1] + [node for node in range(len(graph)) if graph.kinds[node] == graph.ENTITY]
+        for relation in range(len(graph)):
+            if graph.kinds[relation] == graph.RELATION:
+                for entity in entities:
+                    stack = [names[entity]] if entity >= 0 else []
+                    pair_modes[(relation, entity)] = [goal_modes[mode] for mode in
+                                                      self.random_walk_relation_modes(names[relation], stack)
+                                                      if mode in goal_modes]
+        goals = (len(goal_modes), goal_visits, pair_modes)
+
+        # Each walk is summarized by the nodes it visited and the (relation, last entity) pairs it walked through,
+        # which is all random_walk needs to instantiate the modes.
+        if numpy is not None:
+            summaries, steps, reasons = self.sample_walks_numpy(graph, start, depth, walks, seed, goals, window)
+        else:
+            summaries, steps, reasons = self.sample_walks_python(graph, start, depth, walks, seed, goals, window)
+        self.walk_steps = steps
+        self.walk_stop_reasons = dict((reason, reasons.count(reason)) for reason in set(reasons))
+        if self.stats is not None:
+            self.stats.count('walk_steps', steps)
+
+        counts = {}
+        for visited, pairs in summaries:
+            final_set = set(target_modes)
+            for relation, entity in pairs:
+                stack = [names[entity]] if entity >= 0 else []
+                final_set.update(self.random_walk_relation_modes(names[relation], stack))
+            final_set.update(self.random_walk_unexplored_modes(names[node] for node in visited))
+            for mode in final_set:
+                counts[mode] = counts.get(mode, 0) + 1
+
+        self.mode_frequencies = dict((mode, float(count) / walks) for mode, count in counts.items())
+        selected = sorted(mode for mode, fraction in self.mode_frequencies.items() if fraction >= threshold)
+        self.all_modes = ['mode: ' + element for element in selected]
+        self.all_modes_boostsrl = selected
+
+    def sample_walks_numpy(self, graph, start, depth, walks, seed, goals, window=None):
+        import numpy
+        offsets = numpy.array(graph.offsets, dtype=numpy.int64)
+        adjacency = numpy.array(graph.adjacency, dtype=numpy.int64)
+        degrees = offsets[1:] - offsets[:-1]
+        kinds = numpy.array(graph.kinds, dtype=numpy.int8)
+        n = len(graph)
+        rng = random.Random(seed)
+
+        # The goals as arrays: a flag per node for the visits, and the two modes (at most) of each pair, by the
+        # pair's code relation * (n + 1) + entity + 1. Mode number `modes` is a placeholder that is always seen.
+        modes, goal_visits, pair_modes = goals
+        is_goal_visit = numpy.zeros(n, dtype=bool)
+        is_goal_visit[list(goal_visits)] = True
+        pair_codes = numpy.array(sorted(relation * (n + 1) + entity + 1 for relation, entity in pair_modes),
+                                 dtype=numpy.int64)
+        first_mode = numpy.full(len(pair_codes), modes, dtype=numpy.int64)
+        second_mode = numpy.full(len(pair_codes), modes, dtype=numpy.int64)
+        for (relation, entity), numbers in pair_modes.items():
+            i = numpy.searchsorted(pair_codes, relation * (n + 1) + entity + 1)
+            for column, number in zip((first_mode, second_mode), numbers):
+                column[i] = number
+
+        walkers = numpy.arange(walks)
+        positions = numpy.full(walks, start, dtype=numpy.int64)
+        last_entity = numpy.full(walks, -1, dtype=numpy.int64)
+        visited = numpy.zeros((walks, n), dtype=bool)
+        seen_modes = numpy.zeros((walks, modes + 1), dtype=bool)
+        seen_modes[:, modes] = True
+        remaining = numpy.full(walks, modes + len(goal_visits), dtype=numpy.int64)
+        quiet = numpy.zeros(walks, dtype=numpy.int64)
+        steps = numpy.zeros(walks, dtype=numpy.int64)
+        reasons = numpy.array(['depth'] * walks, dtype=object)
+        codes = []
+
+        alive = walkers
+        for step in range(depth - 1):
+            # Walkers that cannot produce anything new stop, like random_walk.
+            covered = remaining[alive] == 0
+            reasons[alive[covered]] = 'coverage'
+            stopped = covered
+            if window is not None:
+                waited = ~covered & (quiet[alive] >= window)
+                reasons[alive[waited]] = 'window'
+                stopped = covered | waited
+            alive = alive[~stopped]
+            if not len(alive):
+                break
+
+            # Sample the next node of every walker at once, from the numbers sample_walks_python would draw.
+            uniform = numpy.fromiter((rng.random() for _ in range(len(alive))), dtype=numpy.float64, count=len(alive))
+            choice = (uniform * degrees[positions[alive]]).astype(numpy.int64)
+            current = adjacency[offsets[positions[alive]] + choice]
+            positions[alive] = current
+            steps[alive] += 1
+
+            progress = is_goal_visit[current] & ~visited[alive, current]
+            visited[alive, current] = True
+            remaining[alive] -= progress
+
+            kind = kinds[current]
+            entity = kind == graph.ENTITY
+            last_entity[alive[entity]] = current[entity]
+            relation = kind == graph.RELATION
+            if relation.any():
+                moving = alive[relation]
+                # Encode (walker, relation, last entity) as one integer.
+                pair = current[relation] * (n + 1) + last_entity[moving] + 1
+                codes.append(moving * (n * (n + 1)) + pair)
+                index = numpy.searchsorted(pair_codes, pair)
+                new_modes = numpy.zeros(len(moving), dtype=numpy.int64)
+                for column in (first_mode, second_mode):
+                    number = column[index]
+                    new = ~seen_modes[moving, number]
+                    seen_modes[moving, number] = True
+                    new_modes += new
+                remaining[moving] -= new_modes
+                progress[relation] |= new_modes > 0
+            quiet[alive] = numpy.where(progress, 0, quiet[alive] + 1)
+            if len(codes) > 256:
+                codes = [numpy.unique(numpy.concatenate(codes))]
+
+        pairs = [[] for _ in range(walks)]
+        if codes:
+            for code in numpy.unique(numpy.concatenate(codes)).tolist():
+                walker_relation, entity = divmod(code, n + 1)
+                walker_id, relation = divmod(walker_relation, n)
+                pairs[walker_id].append((relation, entity - 1))
+        summaries = [(numpy.flatnonzero(visited[i]).tolist(), pairs[i]) for i in range(walks)]
+        return summaries, int(steps.sum()), reasons.tolist()
+
+    def sample_walks_python(self, graph, start, depth, walks, seed, goals, window=None):
+        # The same steps as sample_walks_numpy: every walker that is still walking moves once per step, in order.
+        rng = random.Random(seed)
+        modes, goal_visits, pair_modes = goals
+        nodes = [start] * walks
+        last_entity = [-1] * walks
+        visited = [set() for _ in range(walks)]
+        pairs = [set() for _ in range(walks)]
+        seen_modes = [set() for _ in range(walks)]
+        remaining = [modes + len(goal_visits)] * walks
+        quiet = [0] * walks
+        reasons = ['depth'] * walks
+        total = 0
+
+        alive = list(range(walks))
+        for step in range(depth - 1):
+            walking = []
+            for i in alive:
+                if not remaining[i]:
+                    reasons[i] = 'coverage'
+                elif (window != None) and quiet[i] >= window:
+                    reasons[i] = 'window'
+                else:
+                    walking.append(i)
+            alive = walking
+            if not alive:
+                break
+
+            for i in alive:
+                neighbors = graph.neighbors(nodes[i])
+                node = nodes[i] = neighbors[int(rng.random() * len(neighbors))]
+                total += 1
+                quiet[i] += 1
+                if node not in visited[i]:
+                    visited[i].add(node)
+                    if node in goal_visits:
+                        remaining[i] -= 1
+                        quiet[i] = 0
+                kind = graph.kinds[node]
+                if kind == graph.ENTITY:
+                    last_entity[i] = node
+                elif kind == graph.RELATION and (node, last_entity[i]) not in pairs[i]:
+                    pairs[i].add((node, last_entity[i]))
+                    for number in pair_modes.get((node, last_entity[i]), ()):
+                        if number not in seen_modes[i]:
+                            seen_modes[i].add(number)
+                            remaining[i] -= 1
+                            quiet[i] = 0
+        return list(zip(visited, pairs)), total, reasons
+
+    @timed('paths')
     def paths_from_target_to_features(self):
-        graph = self.Graph
+        graph = self.graph
         all_paths = []
         if self.verbose:
             print('\nAll paths from target to features:')
-        for feature in self.importants:
-            p = self.find_all_paths(graph, self.target, feature)
-            all_paths.append(p)
+        buckets = {}
+
+        # Paths computed by an earlier run on the same diagram are reused as they are.
+        if self.cache is not None:
+            for feature in self.importants:
+                cached = self.cache.load_paths(self.diagram, self.target, feature)
+                if cached is not None:
+                    buckets[graph.intern(feature)] = [[graph.intern(name) for name in path] for path in cached]
+        missing = [feature for feature in self.feature_ids if feature not in buckets]
+
+        if self.budgeted():
+            for feature in list(buckets):
+                buckets[feature] = self.apply_budgets(buckets[feature])
+            buckets.update(self.bounded_paths_to_features(missing))
+        else:
+            # Walk from the target once, sorting every path that reaches a feature into that feature's bucket.
+            for feature in missing:
+                buckets[feature] = []
+            for feature, path in self.find_paths_to_features(graph, self.target_id, missing):
+                buckets[feature].append(path)
+        for feature in self.feature_ids:
+            all_paths.append(buckets[feature])
+
+        # Paths cut short by a budget are not stored: a later run may have more room.
+        if self.cache is not None and missing and self.budget_hit is None:
+            names = self.names
+            self.cache.store_paths(self.diagram, dict(((self.target, names[feature]),
+                                                       [[names[node] for node in path] for path in buckets[feature]])
+                                                      for feature in missing))
+        if self.verbose:
+            print('Pruned', self.pruned, 'nodes that could not lead to a feature.')
+        self.record_paths(all_paths)
         return all_paths
 
-    def path_powerset(self, graph):
-        pass
+    def record_paths(self, all_paths):
+        '''
+        path_calls and nodes_visited cover every traversal, so with budgets they include the levels that
+        iterative deepening walks again; deepening_repeated_calls is that share of path_calls.
+        '''
+        if self.stats is None:
+            return
+        self.stats.count('path_calls', self.calls)
+        self.stats.count('nodes_visited', self.nodes_visited)
+        self.stats.count('nodes_pruned', self.pruned)
+        if self.deepening_passes:
+            self.stats.count('deepening_passes', self.deepening_passes)
+            self.stats.count('deepening_repeated_calls', self.repeated_calls)
+        for feature, paths in zip(self.importants, all_paths):
+            self.stats.count('paths_per_feature', len(paths), key=self.target + '|' + feature)
+
+    def budgeted(self):
+        return not (self.max_depth is None and self.max_paths is None and self.time_budget is None)
+
+    def hit_budget(self, budget):
+        if self.budget_hit is None:
+            self.budget_hit = budget
+
+    def apply_budgets(self, paths):
+        '''Cut a complete list of paths down to the depth and path budgets, shortest paths first.'''
+        paths = sorted(paths, key=len)
+        if self.max_depth is not None and paths and len(paths[-1]) - 1 > self.max_depth:
+            self.hit_budget('depth')
+            paths = [path for path in paths if len(path) - 1 <= self.max_depth]
+        if self.max_paths is not None and len(paths) > self.max_paths:
+            self.hit_budget('paths')
+            paths = paths[:self.max_paths]
+        return paths
+
+    def bounded_paths_to_features(self, features):
+        '''
+        Anytime walk: iterative deepening from the target, so the paths to each feature are found shortest first.
+        Stops when a budget runs out, and whatever was found up to then is still a valid set of paths.
+        Returns {feature: paths}.
+        '''
+        deadline = None
+        if self.time_budget is not None:
+            deadline = time.time() + self.time_budget
+        buckets = dict((feature, []) for feature in features)
+        unfilled = list(features)
+        length = 0
+        previous_calls = 0
+
+        while unfilled:
+            self.cut_off = False
+            calls = self.calls
+            for feature, path in self.find_paths_to_features(self.graph, self.target_id, unfilled, length, deadline):
+                if self.max_paths is not None and len(buckets[feature]) >= self.max_paths:
+                    self.hit_budget('paths')
+                    continue
+                buckets[feature].append(path)
+            # Each traversal walks again everything the previous, one edge shallower, traversal walked.
+            self.deepening_passes += 1
+            self.repeated_calls += min(previous_calls, self.calls - calls)
+            previous_calls = self.calls - calls
+            if self.budget_hit == 'time':
+                break
+            self.explored_depth = length
+            if not self.cut_off:
+                # Nothing longer left to walk.
+                break
+            if self.max_depth is not None and length >= self.max_depth:
+                self.hit_budget('depth')
+                break
+            if self.max_paths is not None:
+                unfilled = [feature for feature in unfilled if len(buckets[feature]) < self.max_paths]
+                if not unfilled:
+                    self.hit_budget('paths')
+            length += 1
+        return buckets
+
+    def budget_summary(self):
+        '''One line saying which budget, if any, stopped the walk.'''
+        if self.budget_hit is None:
+            return 'no budget was hit'
+        budgets = {'depth': 'the depth budget (' + str(self.max_depth) + ' edges)',
+                   'paths': 'the path budget (' + str(self.max_paths) + ' paths per feature)',
+                   'time': 'the time budget (' + str(self.time_budget) + ' seconds)'}
+        summary = 'stopped by ' + budgets[self.budget_hit]
+        if self.explored_depth is not None:
+            summary += ', paths up to ' + str(self.explored_depth) + ' edges were fully explored'
+        return summary
+
+    @timed('paths')
+    def shortest_paths_from_target_to_features(self):
+        '''
+        Breadth-first search from the target, keeping every predecessor that lies on a shortest path.
+        Only the equal-length shortest paths to each feature are enumerated from that DAG, so the
+        result matches keeping the shortest of all simple paths, without enumerating every one of them.
+        '''
+        graph = self.graph
+        target = self.target_id
+        all_paths = []
+        if self.verbose:
+            print('\nShortest paths from target to features:')
+
+        distance = {target: 0}
+        predecessors = {target: []}
+        frontier = [target]
+        while frontier:
+            next_frontier = []
+            for node in frontier:
+                self.calls += 1
+                for neighbor in graph.neighbors(node):
+                    self.nodes_visited += 1
+                    if neighbor not in distance:
+                        distance[neighbor] = distance[node] + 1
+                        predecessors[neighbor] = [node]
+                        next_frontier.append(neighbor)
+                    elif distance[neighbor] == distance[node] + 1:
+                        predecessors[neighbor].append(node)
+            frontier = next_frontier
+
+        deadline = None
+        if self.time_budget is not None:
+            deadline = time.time() + self.time_budget
+
+        for feature in self.feature_ids:
+            paths = []
+            if feature in distance and self.max_depth is not None and distance[feature] > self.max_depth:
+                self.hit_budget('depth')
+            elif feature in distance and self.budget_hit != 'time':
+                # Follow the predecessors back to the target, reversing each completed path.
+                stack = [[feature]]
+                while stack:
+                    if deadline is not None and time.time() > deadline:
+                        self.hit_budget('time')
+                        break
+                    partial = stack.pop()
+                    if partial[-1] == target:
+                        paths.append(list(reversed(partial)))
+                        if self.max_paths is not None and len(paths) >= self.max_paths:
+                            if stack:
+                                self.hit_budget('paths')
+                            break
+                        continue
+                    for predecessor in predecessors[partial[-1]]:
+                        stack.append(partial + [predecessor])
+            all_paths.append(paths)
+        self.record_paths(all_paths)
+        return all_paths
+
+    @timed('nowalk')
+    def nowalk(self):
+        '''
+        -n: instantiate the predicates from the breadth-first layers around the target, without walking paths.
+        Each node keeps the distinct sets of variables that the shortest paths reaching it have bound, and every
+        edge from one layer into the next instantiates the next predicate once per set. The modes are the same
+        as -s over every feature, but shared path prefixes and paths that bind the same variables are only
+        walked once, so the cost grows with the edges times the distinct sets rather than with the number of
+        paths. Predicates that cannot be reached from the target are instantiated with '+' everywhere.
+        '''
+        graph = self.graph
+        names = self.names
+        target = self.target
+        final_set = set()
+
+        if target in self.attribute_dict:
+            target_variables = [self.attribute_dict[target]]
+        else:
+            target_variables = self.relations_dict[target]
+
+        # The distinct sets of variables bound after walking a shortest path to each node reached so far.
+        # They are not merged: a predicate instantiated with the union of two paths' variables would get
+        # '+' arguments that neither path binds.
+        bound = {self.target_id: set([frozenset(self.instantiate(target, set(target_variables), final_set))])}
+        frontier = [self.target_id]
+        while frontier:
+            layer = {}
+            for node in frontier:
+                for neighbor in graph.neighbors(node):
+                    if neighbor in bound:
+                        continue
+                    states = layer.setdefault(neighbor, set())
+                    for variables in bound[node]:
+                        states.add(frozenset(self.instantiate(names[neighbor], set(variables), final_set)))
+            bound.update(layer)
+            frontier = list(layer)
+
+        explored = set(names[node] for node in bound)
+        unexplored = list(set(self.relations_dict.keys()).union(set(self.attribute_dict.keys())) - explored)
+
+        if self.verbose:
+            print('\nTarget:', str(target))
+            print('Predicates reached from the target:', str(sorted(explored)))
+            print('Predicates not reached from the target:', str(unexplored))
+
+        for predicate in unexplored:
+            mode = self.unexplored_mode(predicate)
+            if mode is not None:
+                final_set.add(mode)
+                self.modes_generated += 1
+
+        self.all_modes = ['mode: ' + element for element in sorted(final_set)]
+        self.all_modes_boostsrl = sorted(final_set)
+        self.record_modes(final_set)
+
+    def record_modes(self, final_set):
+        if self.stats is None:
+            return
+        self.stats.count('modes_before_dedup', self.modes_generated)
+        self.stats.count('modes', len(final_set))
+
+    def path_powerset(self, all_paths):
+        '''
+        Lazily yield the distinct mode sets (like self.all_modes) that walkFeatures produces for each subset of the
+        paths in all_paths (one list of paths per feature, as returned by paths_from_target_to_features).
+        A path only matters through the modes it instantiates and the predicates it explores, so subsets are only
+        extended with paths that add one of those, and a mode set that was already produced is not yielded again.
+        Memory is a stack of subsets plus one hash per distinct mode set, however many paths there are.
+        '''
+        names = self.names
+        target = self.target
+        if target in self.attribute_dict:
+            target_variables = [self.attribute_dict[target]]
+        else:
+            target_variables = self.relations_dict[target]
+
+        # Modes are numbered, and sets of modes or predicates are stored as bits of an integer.
+        bits = {}
+        def bit(item):
+            if item not in bits:
+                bits[item] = 1 << len(bits)
+            return bits[item]
+
+        # Reduce each path to (modes instantiated along it, predicates explored by it), dropping duplicates.
+        summaries = []
+        seen = set()
+        for lsa in all_paths:
+            for path in lsa:
+                modes = set()
+                instantiated_variables = set(target_variables)
+                for node in path:
+                    instantiated_variables = self.instantiate(names[node], instantiated_variables, modes)
+                summary = (sum(bit(('mode', mode)) for mode in modes),
+                           sum(bit(('predicate', names[node])) for node in set(path)))
+                if summary not in seen:
+                    seen.add(summary)
+                    summaries.append(summary)
+
+        # Predicates left out of a subset are instantiated with '+' everywhere.
+        unexplored = []
+        for predicate in set(self.relations_dict.keys()).union(set(self.attribute_dict.keys())):
+            mode = self.unexplored_mode(predicate)
+            if mode is not None:
+                unexplored.append((bit(('predicate', predicate)), bit(('mode', mode))))
+        modes_by_bit = dict((value, key[1]) for key, value in bits.items() if key[0] == 'mode')
+
+        produced = set()
+        # Each subset is (index of the next path that may be added, modes, explored predicates).
+        stack = [(0, 0, 0)]
+        while stack:
+            start, modes, explored = stack.pop()
+            final_modes = modes
+            for predicate_bit, mode_bit in unexplored:
+                if not (explored & predicate_bit):
+                    final_modes |= mode_bit
+            digest = hashlib.sha1(('%x' % final_modes).encode('ascii')).digest()
+            if digest not in produced:
+                produced.add(digest)
+                final_set = [modes_by_bit[b] for b in modes_by_bit if final_modes & b]
+                yield ['mode: ' + element for element in sorted(final_set)]
+
+            for index in range(len(summaries) - 1, start - 1, -1):
+                path_modes, path_predicates = summaries[index]
+                if (path_modes | modes) != modes or (path_predicates | explored) != explored:
+                    stack.append((index + 1, modes | path_modes, explored | path_predicates))
+
+    def instantiate(self, predicate, instantiated_variables, final_set):
+        '''
+        Add the modes for reaching predicate with instantiated_variables already bound (+) to final_set.
+        Returns the variables that are bound after walking through predicate.
+        '''
+        target = self.target
+
+        if predicate in self.attribute_dict:
+            out = []
+
+            # Note: multivalued attributes need to be handled as #, while non-multivalued need nothing.
+            if predicate in self.multi_value_attributes:
+                multi = ',#' + predicate.lower()
+            else:
+                multi = ''
+
+            if self.attribute_dict[predicate] in instantiated_variables:
+                out.append("+%s" % self.attribute_dict[predicate])
+            else:
+                out.append("-%s" % self.attribute_dict[predicate])
+            final_set.add(str(predicate +
+                              '(' + ','.join(out) +
+                              multi + ').'))
+            self.modes_generated += 1
+            return instantiated_variables.union(set(self.attribute_dict[predicate]))
+
+        elif predicate in self.relations_dict:
+            # Note: needs a check for whether the relationship is reflexive. (e.g. FatherOf Relationship)
+            REFLEXIVE = False
+            out = []
+
+            variables = self.relations_dict[predicate]
+            # reverse the order of the variables for correct predicate logic format:
+            #variables = list(reversed(variables))
+
+            for var in variables:
+                if var in instantiated_variables:
+                    out.append("+%s" % var)
+                else:
+                    out.append("-%s" % var)
+
+            if len(variables) == 1:
+                REFLEXIVE = True
+                if (predicate == target):
+                    out.append("+%s" % var)
+                else:
+                    out.append("-%s" % var)
+            final_set.add(str(predicate + '(' + ','.join(out) + ').'))
+            self.modes_generated += 1
+
+            if REFLEXIVE:
+                outrev = list(reversed(out))
+                final_set.add(str(predicate + '(' + ','.join(outrev) + ').'))
+                self.modes_generated += 1
+
+            return instantiated_variables.union(set(self.relations_dict[predicate]))
+
+        # Predicate is an entity and we can skip it.
+        return instantiated_variables
+
+    def unexplored_mode(self, predicate):
+        '''Predicates that were not explored by walking are instantiated with '+' everywhere.'''
+        if predicate in self.attribute_dict:
+
+            # Note: multivalued attributes need to be handled as #, while non-multivalued need nothing.
+            if predicate in self.multi_value_attributes:
+                multi = ',#' + predicate.lower()
+            else:
+                multi = ''
+
+            return str(predicate +
+                       '(+' + self.attribute_dict[predicate] + multi +
+                       ').')
+
+        elif predicate in self.relations_dict:
+            out = []
+
+            variables = self.relations_dict[predicate]
+            # reverse the order of the variables for correct predicate logic format:
+            #variables = list(reversed(variables))
+
+            for var in variables:
+                out.append("+%s" % var)
+                # A small fix for reflexive relationships:
+                if len(variables) == 1:
+                    out.append("+%s" % var)
+            return str(predicate + '(' + ','.join(out) + ').')
+
+    def sweep_features(self, all_paths, shortest=False):
+        '''
+        The modes walkFeatures would produce for the first 1, 2, ... len(all_paths) features, built incrementally:
+        the paths to feature N are added to the trie left by the first N-1 features, and only the predicates they
+        explore leave the unexplored modes. Sets self.all_modes and self.all_modes_boostsrl and yields
+        self.all_modes for each number of features.
+        '''
+        names = self.names
+        target = self.target
+        if target in self.attribute_dict:
+            target_variables = [self.attribute_dict[target]]
+        else:
+            target_variables = self.relations_dict[target]
+
+        explored_modes = set()
+        unexplored = {}
+        for predicate in set(self.relations_dict.keys()).union(set(self.attribute_dict.keys())):
+            mode = self.unexplored_mode(predicate)
+            if mode is not None:
+                unexplored[predicate] = mode
 
+        # node id -> (variables bound after walking through the node, child trie)
+        trie = {}
+        for lsa in all_paths:
+            lsa = list(lsa)
+            if shortest and lsa:
+                shortest_len = min([len(x) for x in lsa])
+                lsa = [y for y in lsa if len(y) == shortest_len]
+
+            for path in lsa:
+                children = trie
+                instantiated_variables = set(target_variables)
+                for node in path:
+                    if node not in children:
+                        child_variables = self.instantiate(names[node], instantiated_variables, explored_modes)
+                        children[node] = (child_variables, {})
+                        unexplored.pop(names[node], None)
+                    instantiated_variables, children = children[node]
+
+            final_set = explored_modes.union(unexplored.values())
+            self.all_modes = ['mode: ' + element for element in sorted(final_set)]
+            self.all_modes_boostsrl = sorted(final_set)
+            yield self.all_modes
+
+    @timed('instantiate')
     def walkFeatures(self, all_paths, shortest=False):
         '''
         Use user-selected features to construct background/modes.
         Input: [target], [list of features]
         Output: (print modes to terminal or write to a file)
         '''
-        graph = self.Graph
+        names = self.names
         target = self.target
         features = self.importants
 
@@ -405,147 +1839,1591 @@ class Networks:
             target_variables = self.relations_dict[target]
         #print(target_variables)
 
-        final_set = []
+        # Modes are deduplicated as they are produced.
+        final_set = set()
 
         if shortest:
             # Prefer the shortest paths between the target and features.
             new_all_paths = []
             for lsa in all_paths:
+                lsa = list(lsa)
+                if not lsa:
+                    # The feature cannot be reached from the target.
+                    new_all_paths.append(lsa)
+                    continue
                 shortest_len = min([len(x) for x in lsa])
                 new_all_paths.append([y for y in lsa if len(y) == shortest_len])
             all_paths = new_all_paths
 
-        merged = list(itertools.chain(*all_paths))
-        merged = list(itertools.chain(*merged))
-        
+        # Paths from the target share long prefixes: merge them into a trie (node id -> child trie)
+        # so that the instantiation of each shared prefix is only computed once.
+        trie = {}
+        for lsa in all_paths:
+            for lsb in lsa:
+                cursor = trie
+                for node in lsb:
+                    cursor = cursor.setdefault(node, {})
+
+        # Every node in the trie was explored by walking.
+        merged = set()
+
+        # Depth-first over the trie, carrying the variables instantiated by the prefix above each node.
+        stack = [(trie, set(target_variables))]
+        while stack:
+            children, instantiated_variables = stack.pop()
+            for node, child in children.items():
+                merged.add(node)
+                predicate = names[node]
+                child_variables = self.instantiate(predicate, instantiated_variables, final_set)
+                if child:
+                    stack.append((child, child_variables))
+
         # Some predicates will not be explored, store them in a list.
-        unexplored = list(set(self.relations_dict.keys()).union(set(self.attribute_dict.keys())) - set(merged))
-        
+        merged = set(names[node] for node in merged)
+        unexplored = list(set(self.relations_dict.keys()).union(set(self.attribute_dict.keys())) - merged)
+
         if self.verbose:
             print('\nTarget and Features:', str(target), str(features))
-            print('Predicates explored by walking:', str(list(set(merged))))
+            print('Predicates explored by walking:', str(list(merged)))
             print('Predicates not explored by walking:', str(unexplored))
 
-        for lsa in all_paths:
-            for lsb in lsa:
+        # Handle "Unexplored" attributes, relations, and entities
+        for predicate in unexplored:
+            mode = self.unexplored_mode(predicate)
+            if mode is not None:
+                final_set.add(mode)
+                self.modes_generated += 1
+
+        self.all_modes = ['mode: ' + element for element in sorted(final_set)]
+        self.all_modes_boostsrl = sorted(final_set)
+        self.record_modes(final_set)
+        #print('\n//background')
+        #print('//target is', target)
+        #for mode in self.all_modes:
+        #    print(mode)
 
-                instantiated_variables = set(target_variables)
-                for predicate in lsb:
-                    if predicate in self.attribute_dict:
-                        out = []
-
-                        # Note: multivalued attributes need to be handled as #, while non-multivalued need nothing.
-                        if predicate in self.multi_value_attributes:
-                            multi = ',#' + predicate.lower()
-                        else:
-                            multi = ''
-
-                        if self.attribute_dict[predicate] in instantiated_variables:
-                            out.append("+%s" % self.attribute_dict[predicate])
-                        else:
-                            out.append("-%s" % self.attribute_dict[predicate])
-                        final_set.append(str(predicate +
-                                             '(' + ','.join(out) +
-                                             multi + ').'))
-                        instantiated_variables = instantiated_variables.union(set(self.attribute_dict[predicate]))
-                        
-                    elif predicate in self.relations_dict:
-                        # Note: needs a check for whether the relationship is reflexive. (e.g. FatherOf Relationship)
-                        REFLEXIVE = False
-                        out = []
-
-                        variables = self.relations_dict[predicate]
-                        # reverse the order of the variables for correct predicate logic format:
-                        #variables = list(reversed(variables))
-
-                        for var in variables:
-                            if var in instantiated_variables:
-                                out.append("+%s" % var)
-                            else:
-                                out.append("-%s" % var)
-
-                        if len(variables) == 1:
-                            REFLEXIVE = True
-                            if (predicate == target):
-                                out.append("+%s" % var)
-                            else:
-                                out.append("-%s" % var)
-                        final_set.append(str(predicate + '(' + ','.join(out) + ').'))
-                        
-                        if REFLEXIVE:
-                            outrev = list(reversed(out))
-                            final_set.append(str(predicate + '(' + ','.join(outrev) + ').'))
-
-                        instantiated_variables = instantiated_variables.union(set(self.relations_dict[predicate]))
+class walker:
 
-                    else:
-                        # Predicate is an entity and we can skip it.
+    """
+    "Main" class to run WalkER with the assumption that it was imported as a package.
+        - diagram_file_string -> the contents of a diagram file (a string)
+
+    The diagram is parsed once. walk(), shortest(), exhaustive(), random(), random_walk() and nowalk() return
+    the modes (networks.all_modes, or networks.all_modes_boostsrl with boostsrl=True), and results are
+    remembered per (mode, target, features) so repeating a query does not walk the diagram again.
+        e.g. walker(open('diagrams/imdb.mayukh').read()).walk(number=2)
+    max_depth, max_paths and time_budget bound the walking modes like --max-depth, --max-paths-per-feature
+    and --time-budget; results that were cut short by a budget are not remembered.
+    With stats=True, self.stats (a Stats) collects the timings and counters of --stats across calls.
+    """
+
+    def __init__(self, diagram_file_string, verbose=False, cache=None, dictionaries=None,
+                 max_depth=None, max_paths=None, time_budget=None, stats=False):
+        self.verbose = verbose
+        self.memo = {}
+        self.stats = Stats() if stats else None
+        self.paths = {} # (target, feature) -> the paths walked from the target to the feature
+        self.budgets = {'max_depth': max_depth, 'max_paths': max_paths, 'time_budget': time_budget}
+        if dictionaries is not None:
+            # Already parsed (e.g. handed to a worker process).
+            self.dictionaries = dictionaries
+            if stats:
+                self.dictionaries.stats = self.stats
+            return
+        if (len(diagram_file_string.splitlines()) != 6):
+            raise ExceptionCase('Error [1]: Diagram has the wrong number of lines.')
+        self.dictionaries = BuildDictionaries(diagram_file_string, verbose=verbose, cache=cache, stats=self.stats)
+
+    def check_target(self, target):
+        if target is None:
+            target = self.dictionaries.target
+        if not (target in self.dictionaries.relations_dict or target in self.dictionaries.attribute_dict):
+            raise ExceptionCase('Error [1]: Target is not a relation or attribute in the diagram: "' + str(target) + '"')
+        return target
+
+    def important_features(self, number=None):
+        '''The first number features of the Important list (all of them when number is None).'''
+        if (number == None):
+            return list(self.dictionaries.importants)
+        if (number < 0):
+            raise ExceptionCase('Error [1]: Cannot have negative features.')
+        return self.dictionaries.importants[:number]
+
+    def rank_features(self, dataset_dir, target=None, processes=None):
+        '''
+        --rank-features: reorder the Important features with the examples of target (default: the diagram's
+        target) in the train folds of dataset_dir, so that number counts from the most informative ones.
+        Returns the ranking, see FeatureRanking.rank.
+        '''
+        target = self.check_target(target)
+        return FeatureRanking(self.dictionaries, dataset_dir, target=target, processes=processes,
+                              verbose=self.verbose).apply()
+
+    def all_features(self, target):
+        '''Every relation and attribute except the target.'''
+        return sorted(set(self.dictionaries.relations).union(set(self.dictionaries.attributes)) - set([target]))
+
+    def draw_features(self, target, number, rng):
+        '''The features -r walks to: a sample of number features (a random number of them when number is None).'''
+        all_features = self.all_features(target)
+        if (number == None):
+            return rng.sample(all_features, rng.randint(1, len(all_features)))
+        elif (number > len(all_features)):
+            return rng.sample(all_features, len(all_features))
+        return rng.sample(all_features, number)
+
+    def feature_paths(self, networks):
+        '''
+        The paths from networks.target to each of its features, as paths_from_target_to_features returns them.
+        Walks only to the features that no earlier call walked to; without budgets the paths are kept in self.paths.
+        '''
+        if any(budget is not None for budget in self.budgets.values()):
+            return networks.paths_from_target_to_features()
+
+        target = networks.target
+        missing = [feature for feature in OrderedDict.fromkeys(networks.importants) if (target, feature) not in self.paths]
+        if missing:
+            walked = Networks(target, missing, self.dictionaries, verbose=self.verbose)
+            for feature, paths in zip(missing, walked.paths_from_target_to_features()):
+                self.paths[(target, feature)] = paths
+        return [self.paths[(target, feature)] for feature in networks.importants]
+
+    def result(self, key, networks, boostsrl):
+        if networks is not None:
+            self.memo[key] = (networks.all_modes, networks.all_modes_boostsrl)
+        modes = self.memo[key][1] if boostsrl else self.memo[key][0]
+        # Copy, so callers cannot change the remembered result.
+        return list(modes)
+
+    def run(self, mode, target, features, boostsrl):
+        key = (mode, target, tuple(features))
+        if key in self.memo:
+            return self.result(key, None, boostsrl)
+
+        networks = Networks(target, features, self.dictionaries, verbose=self.verbose, **self.budgets)
+        if mode == 'shortest':
+            networks.walkFeatures(networks.shortest_paths_from_target_to_features(), shortest=True)
+        else:
+            networks.walkFeatures(self.feature_paths(networks))
+        if networks.budget_hit is not None:
+            return list(networks.all_modes_boostsrl if boostsrl else networks.all_modes)
+        return self.result(key, networks, boostsrl)
+
+    def walk(self, features=None, target=None, number=None, boostsrl=False):
+        '''-w: walk from the target to the features (default: the Important features, limited to number).'''
+        target = self.check_target(target)
+        if features is None:
+            features = self.important_features(number)
+        return self.run('walk', target, features, boostsrl)
+
+    def shortest(self, features=None, target=None, number=None, boostsrl=False):
+        '''-s: like walk, but only keep the shortest paths to each feature.'''
+        target = self.check_target(target)
+        if features is None:
+            features = self.important_features(number)
+        return self.run('shortest', target, features, boostsrl)
+
+    def exhaustive(self, target=None, boostsrl=False):
+        '''-e: walk from the target to every other relation and attribute.'''
+        target = self.check_target(target)
+        return self.run('walk', target, self.all_features(target), boostsrl)
+
+    def random(self, target=None, number=None, seed=None, boostsrl=False):
+        '''-r: walk from the target to a random sample of features.'''
+        target = self.check_target(target)
+        rng = random.Random(seed) if seed is not None else random
+        features = self.draw_features(target, number, rng)
+
+        # Once the features are drawn, this is an ordinary walk.
+        return self.run('walk', target, features, boostsrl)
+
+    def random_walk(self, target=None, depth=10000, seed=None, boostsrl=False, walks=1, threshold=0.5, window=None):
+        '''
+        -rw: a random walk from the target, or an ensemble of walks (--walks) filtered by threshold.
+        Every walk stops after window steps without a new mode. Only remembered when a seed makes it repeatable.
+        '''
+        target = self.check_target(target)
+        key = ('randomwalk', target, depth, seed, walks, threshold, window)
+        if seed is not None and key in self.memo:
+            return self.result(key, None, boostsrl)
+
+        networks = Networks(target, [], self.dictionaries, verbose=self.verbose)
+        if walks > 1:
+            networks.random_walk_ensemble(networks.graph, networks.target_id, depth, walks, seed=seed, threshold=threshold,
+                                          window=window)
+        else:
+            rng = random.Random(seed) if seed is not None else random
+            networks.random_walk(networks.graph, networks.target_id, depth, rng=rng, window=window)
+
+        if seed is None:
+            return list(networks.all_modes_boostsrl if boostsrl else networks.all_modes)
+        return self.result(key, networks, boostsrl)
+
+    def powerset(self, features=None, target=None, number=None):
+        '''
+        Generator over the distinct mode sets built from each subset of the paths to the features
+        (see Networks.path_powerset). Nothing is remembered.
+        '''
+        target = self.check_target(target)
+        if features is None:
+            features = self.important_features(number)
+        networks = Networks(target, features, self.dictionaries, verbose=self.verbose, **self.budgets)
+        return networks.path_powerset(networks.paths_from_target_to_features())
+
+    def nowalk(self, target=None, boostsrl=False):
+        '''-n: instantiate every predicate from its distance to the target, without walking.'''
+        target = self.check_target(target)
+        key = ('nowalk', target)
+        if key in self.memo:
+            return self.result(key, None, boostsrl)
+
+        networks = Networks(target, [], self.dictionaries, verbose=self.verbose)
+        networks.nowalk()
+        return self.result(key, networks, boostsrl)
+
+    def modes(self, mode, target=None, features=None, number=None, seed=None, boostsrl=False):
+        '''
+        Dispatch on the name of a mode: 'walk', 'shortest', 'exhaustive', 'random', 'randomwalk' or 'nowalk'.
+        For 'randomwalk', number is the depth limit (10,000 when it is None), as with --number.
+        '''
+        if mode == 'walk':
+            return self.walk(features, target, number, boostsrl)
+        elif mode == 'shortest':
+            return self.shortest(features, target, number, boostsrl)
+        elif mode == 'exhaustive':
+            return self.exhaustive(target, boostsrl)
+        elif mode == 'random':
+            return self.random(target, number, seed, boostsrl)
+        elif mode == 'randomwalk':
+            if (number == None):
+                number = 10000
+            return self.random_walk(target, number, seed, boostsrl)
+        elif mode == 'nowalk':
+            return self.nowalk(target, boostsrl)
+        raise ExceptionCase('Error [1]: Unknown mode: "' + str(mode) + '"')
+
+def write_modes(filename, target, modes):
+    '''Write modes the same way they are printed: a "//target is" comment, then one mode per line.'''
+    write_file_atomically(filename, ''.join(line + '\n' for line in ['//target is ' + target] + list(modes)))
+
+# Datasets: datasets/<name>/ holds the folds train1, test1, ..., each with <fold>_facts.txt, _pos.txt, _neg.txt, _bk.txt.
+
+def dataset_folds(dataset_dir):
+    '''The train* and test* fold directories of a dataset, sorted by name.'''
+    folds = []
+    for fold in sorted(os.listdir(dataset_dir)):
+        if (fold.startswith('train') or fold.startswith('test')) and os.path.isdir(os.path.join(dataset_dir, fold)):
+            folds.append(fold)
+    return folds
+
+def write_file_atomically(filename, text, binary=False):
+    # Write to a temporary file and rename it, so readers (BoostSRL, other runs) never see a half-written file.
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb' if binary else 'w') as f:
+            f.write(text)
+        # mkstemp files are private, dataset files are as readable as any other file.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temporary, 0o666 & ~umask)
+        os.rename(temporary, filename)
+    except (IOError, OSError):
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+# A fact or example: predicate(constant, constant, ...), maybe followed by a %-comment.
+FACT = re.compile(r'^\s*(\w+)\((.*?)\)\.\s*(%.*)?$')
+
+def read_facts(filename):
+    '''Yields (predicate, [constants]) for every fact in filename, skipping //-comments.'''
+    with open(filename) as f:
+        for line in f:
+            match = FACT.match(line)
+            if match and not line.lstrip().startswith('//'):
+                yield match.group(1), [constant.strip() for constant in match.group(2).split(',')]
+
+def argument_types(predicate, relations_dict, attribute_dict, multi_value_attributes=None):
+    '''
+    The entity type of each argument of predicate, from RelatedEntities (a reflexive relation has two arguments
+    of its single type) or else AttributeEntityMapping: the entity, then for a multi-valued attribute (as in
+    multi_value_attributes) the value, typed by the attribute's name like hasposition=[Person, hasposition].
+    None if unknown.
+    '''
+    if multi_value_attributes and predicate in multi_value_attributes:
+        return list(multi_value_attributes[predicate])
+    if predicate in relations_dict:
+        types = relations_dict[predicate]
+        if len(types) == 1:
+            return [types[0], types[0]]
+        return list(types)
+    elif predicate in attribute_dict:
+        return [attribute_dict[predicate]]
+    return None
+
+# FactStore: a <fold>_facts.txt parsed once into integer columns, memory-mapped by later runs.
+
+class FactStore:
+
+    # Bumped whenever the layout of the store changes, so older stores are rebuilt.
+    magic = b'WALKER-FACTS-1\n'
+
+    def __init__(self, facts_file, store_file=None, dictionaries=None):
+        '''
+        The store is facts_file + '.store' unless store_file is given, and is rebuilt whenever facts_file has
+        changed since it was written. Layout: magic, the length of a JSON header (4 bytes), the header, then the
+        data: the interned constants (newline-separated) and one array of constant ids per (predicate, argument).
+        dictionaries (a BuildDictionaries) gives the entity type of each argument, for entity_constants and check.
+        '''
+        self.facts_file = facts_file
+        self.store_file = store_file or facts_file + '.store'
+        self.dictionaries = dictionaries
+        self.names = None
+        self.ids = None
+        self.map = None
+        self.view = None # memoryview of the map, which the columns are slices of (None on Python 2).
+
+        stat = os.stat(facts_file)
+        self.source = {'size': stat.st_size, 'mtime': stat.st_mtime, 'byteorder': sys.byteorder}
+        if not self.open():
+            self.build()
+            if not self.open():
+                raise ExceptionCase('Error [1]: Could not read the fact store: "' + self.store_file + '"')
+
+    def open(self):
+        '''Map the store; False if it is missing, stale, truncated or damaged, so that it gets rebuilt.'''
+        self.close()
+        if not os.path.exists(self.store_file):
+            return False
+        start = len(self.magic) + 4
+        with open(self.store_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < start:
+                # Empty (mmap refuses those) or too short for a header.
+                return False
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(self.magic)] != self.magic:
+            return self.close()
+        try:
+            length = struct.unpack('<I', self.map[len(self.magic):start])[0]
+            if start + length > len(self.map):
+                return self.close()
+            self.header = json.loads(self.map[start:start + length].decode('utf-8'))
+            self.data = start + length
+            if self.header['source'] != self.source or self.header['itemsize'] != array('i').itemsize:
+                return self.close()
+            # The header describes the data: a store cut short after it is damaged too.
+            end = self.data + self.header['constants'][0] + self.header['constants'][1]
+            for entry in self.header['predicates'].values():
+                if entry['columns']:
+                    end = max(end, self.data + entry['columns'][-1] + entry['count'] * self.header['itemsize'])
+        except (struct.error, ValueError, KeyError, TypeError, IndexError):
+            # Truncated or damaged: rebuilt like a stale store.
+            return self.close()
+        if end > len(self.map):
+            return self.close()
+        if hasattr(memoryview, 'cast'):
+            self.view = memoryview(self.map)
+        return True
+
+    def close(self):
+        '''Unmap the store. Returns False, for open().'''
+        if getattr(self, 'view', None) is not None:
+            self.view.release()
+        self.view = None
+        if getattr(self, 'map', None) is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # Columns that were handed out still point into the map: it is unmapped once they are gone.
+                pass
+        self.map = None
+        return False
+
+    def build(self):
+        '''Parse the facts once, interning every constant to an int.'''
+        ids = {}
+        names = []
+        columns = OrderedDict() # predicate -> one array of constant ids per argument
+        skipped = 0
+        for predicate, constants in read_facts(self.facts_file):
+            if predicate not in columns:
+                columns[predicate] = [array('i') for _ in constants]
+            predicate_columns = columns[predicate]
+            if len(constants) != len(predicate_columns):
+                # Every fact of a predicate must have the same number of arguments.
+                skipped += 1
+                continue
+            for column, constant in zip(predicate_columns, constants):
+                if constant not in ids:
+                    ids[constant] = len(names)
+                    names.append(constant)
+                column.append(ids[constant])
+
+        blobs = ['\n'.join(names).encode('utf-8')]
+        offset = len(blobs[0])
+        predicates = OrderedDict()
+        for predicate, predicate_columns in columns.items():
+            offsets = []
+            for column in predicate_columns:
+                blob = column.tobytes() if hasattr(column, 'tobytes') else column.tostring()
+                offsets.append(offset)
+                blobs.append(blob)
+                offset += len(blob)
+            count = len(predicate_columns[0]) if predicate_columns else 0
+            predicates[predicate] = {'count': count, 'columns': offsets}
+
+        header = json.dumps({'source': self.source, 'itemsize': array('i').itemsize, 'skipped': skipped,
+                             'constants': [0, len(blobs[0]), len(names)], 'predicates': predicates}).encode('utf-8')
+        write_file_atomically(self.store_file, b''.join([self.magic, struct.pack('<I', len(header)), header] + blobs),
+                              binary=True)
+
+    def predicates(self):
+        return list(self.header['predicates'].keys())
+
+    def count(self, predicate):
+        '''Number of facts of predicate.'''
+        if predicate not in self.header['predicates']:
+            return 0
+        return self.header['predicates'][predicate]['count']
+
+    def arity(self, predicate):
+        if predicate not in self.header['predicates']:
+            return None
+        return len(self.header['predicates'][predicate]['columns'])
+
+    def constant_names(self):
+        if self.names is None:
+            start, length, count = self.header['constants']
+            self.names = self.map[self.data + start:self.data + start + length].decode('utf-8').split('\n') if count else []
+        return self.names
+
+    def constant_id(self, name):
+        if self.ids is None:
+            self.ids = dict((constant, i) for i, constant in enumerate(self.constant_names()))
+        return self.ids.get(name)
+
+    def column(self, predicate, position):
+        '''
+        The constant ids in argument position (counted from 0) of every fact of predicate: a memoryview of the
+        map, so nothing is copied (an array read from the map on Python 2).
+        '''
+        entry = self.header['predicates'].get(predicate)
+        if entry is None or position >= len(entry['columns']):
+            return array('i')
+        start = self.data + entry['columns'][position]
+        end = start + entry['count'] * self.header['itemsize']
+        if self.view is not None:
+            return self.view[start:end].cast('i')
+        column = array('i')
+        column.fromstring(self.map[start:end])
+        return column
+
+    def constants(self, predicate, position):
+        '''The distinct constants in argument position of predicate, e.g. constants('movie', 0).'''
+        names = self.constant_names()
+        return set(names[i] for i in set(self.column(predicate, position)))
+
+    def facts(self, predicate):
+        '''Yields the arguments of every fact of predicate, as tuples of constants.'''
+        names = self.constant_names()
+        columns = [self.column(predicate, position) for position in range(self.arity(predicate) or 0)]
+        for row in zip(*columns):
+            yield tuple(names[i] for i in row)
+
+    def entity_constants(self, entity):
+        '''Every constant that appears as an argument of type entity, using the types in the diagram.'''
+        relations_dict = self.dictionaries.relations_dict
+        attribute_dict = self.dictionaries.attribute_dict
+        multi_value_attributes = self.dictionaries.multi_value_attributes
+        ids = set()
+        for predicate in self.header['predicates']:
+            for position, kind in enumerate(argument_types(predicate, relations_dict, attribute_dict,
+                                                           multi_value_attributes) or []):
+                if kind == entity:
+                    ids.update(self.column(predicate, position))
+        names = self.constant_names()
+        return set(names[i] for i in ids)
+
+    def check(self):
+        '''Problems between the facts and the diagram: unknown predicates and wrong numbers of arguments.'''
+        relations_dict = self.dictionaries.relations_dict
+        attribute_dict = self.dictionaries.attribute_dict
+        problems = []
+        for predicate in self.header['predicates']:
+            types = argument_types(predicate, relations_dict, attribute_dict)
+            if types is None:
+                problems.append(predicate + ' is not a relation or attribute in the diagram.')
+            elif predicate in relations_dict and self.arity(predicate) != len(types):
+                problems.append(predicate + ' has ' + str(self.arity(predicate)) + ' arguments, the diagram has ' +
+                                str(len(types)) + '.')
+        if self.header['skipped']:
+            problems.append(str(self.header['skipped']) + ' facts had a different number of arguments than the '
+                            'other facts of their predicate and were left out.')
+        return problems
+
+# BackgroundWriter: the shared BoostSRL background file of a dataset, and the import stubs of its folds.
+
+class BackgroundWriter:
+
+    # The settings of the background files shipped in datasets/.
+    default_settings = [('treeDepth', '3'), ('nodeSize', '3')]
+
+    def __init__(self, dataset_dir, settings=None):
+        '''
+        dataset_dir is e.g. datasets/imdb: the background file is datasets/imdb/imdb_bk.txt and every fold
+        (datasets/imdb/train1, test1, ...) imports it from its own <fold>_bk.txt.
+        '''
+        self.dataset_dir = dataset_dir
+        self.name = os.path.basename(os.path.normpath(dataset_dir))
+        self.filename = os.path.join(dataset_dir, self.name + '_bk.txt')
+        if settings is None:
+            settings = self.default_settings
+        self.settings = settings
+
+    def write(self, sections):
+        '''
+        sections is a list of (target, modes). Writes the background file in one go, then the import stub of
+        every fold that does not already import it. Returns the files that were written.
+        '''
+        lines = ['setParam: ' + name + '=' + value + '.' for name, value in self.settings]
+        for target, modes in sections:
+            lines.append('')
+            lines.append('//target is ' + target)
+            lines.extend(modes)
+        write_file_atomically(self.filename, '\n'.join(lines) + '\n')
+        written = [self.filename]
+
+        stub = 'import: "../' + self.name + '_bk.txt".'
+        for fold in dataset_folds(self.dataset_dir):
+            filename = os.path.join(self.dataset_dir, fold, fold + '_bk.txt')
+            if os.path.exists(filename):
+                with open(filename) as f:
+                    if f.read().strip() == stub:
                         continue
+            write_file_atomically(filename, stub + '\n')
+            written.append(filename)
+        return written
+
+# NegativeSampler: negative examples for the target of each fold, typed by the diagram.
+
+def sample_fold_negatives(job):
+    '''
+    job is (fold directory, fold, target, relations_dict, attribute_dict, multi_value_attributes, ratio, seed).
+    Writes <fold>_neg.txt and returns (filename, number of positives, number of negatives). Arguments of the
+    same entity type get different constants, like sample_neg_ex.sh: no workedunder(x, x) among the negatives.
+    '''
+    fold_dir, fold, target, relations_dict, attribute_dict, multi_value_attributes, ratio, seed = job
+    rng = random.Random(seed)
+    prefix = os.path.join(fold_dir, fold)
+    types = argument_types(target, relations_dict, attribute_dict, multi_value_attributes)
+
+    # The constants of each entity type, from every typed argument of the facts and the positive examples.
+    domains = dict((entity, set()) for entity in types)
+    positives = set()
+    examples = 0
+    sources = [prefix + '_facts.txt', prefix + '_pos.txt']
+    for source in sources:
+        if not os.path.exists(source):
+            continue
+        for predicate, constants in read_facts(source):
+            if predicate == target and source.endswith('_pos.txt'):
+                examples += 1
+                if len(constants) == len(types):
+                    positives.add(tuple(constants))
+            predicate_types = argument_types(predicate, relations_dict, attribute_dict, multi_value_attributes) or []
+            for entity, constant in zip(predicate_types, constants):
+                if entity in domains:
+                    domains[entity].add(constant)
+    if examples and not positives:
+        # Rather than replacing the negatives of the fold with nothing.
+        raise ExceptionCase('Error [1]: None of the ' + str(examples) + ' examples of ' + target + ' in "' + prefix +
+                            '_pos.txt" have the ' + str(len(types)) + ' arguments of the diagram.')
+    domains = dict((entity, sorted(constants)) for entity, constants in domains.items())
+    columns = [domains[entity] for entity in types]
+
+    # Positions that share an entity type, which must not repeat a constant.
+    shared = [[position for position, kind in enumerate(types) if kind == entity] for entity in set(types)]
+    shared = [positions for positions in shared if len(positions) > 1]
+
+    def allowed(candidate):
+        return all(len(set(candidate[position] for position in positions)) == len(positions) for positions in shared)
+
+    # The number of allowed tuples: n * (n - 1) * ... for the arguments of each entity type.
+    size = 1
+    for entity in set(types):
+        for repeat in range(types.count(entity)):
+            size *= max(0, len(domains[entity]) - repeat)
+    wanted = int(round(ratio * len(positives)))
+    wanted = max(0, min(wanted, size - len([positive for positive in positives if allowed(positive)])))
+
+    negatives = set()
+    if wanted > size // 2:
+        # Most of the argument tuples are needed: draw them from the full product.
+        candidates = [candidate for candidate in itertools.product(*columns)
+                      if candidate not in positives and allowed(candidate)]
+        negatives.update(rng.sample(candidates, min(wanted, len(candidates))))
+    else:
+        # Rejection sampling, in batches of the number of tuples still missing.
+        while len(negatives) < wanted:
+            for _ in range(wanted - len(negatives)):
+                candidate = tuple(rng.choice(column) for column in columns)
+                if candidate not in positives and allowed(candidate):
+                    negatives.add(candidate)
+
+    filename = prefix + '_neg.txt'
+    write_file_atomically(filename, ''.join(target + '(' + ', '.join(negative) + ').\n' for negative in sorted(negatives)))
+    return filename, len(positives), len(negatives)
+
+class NegativeSampler:
+
+    def __init__(self, dictionaries, dataset_dir, target=None, ratio=3.0, seed=None, processes=None, verbose=False):
+        '''
+        Replaces <fold>_neg.txt in every fold of dataset_dir with ratio times as many negative examples as there are
+        positives: argument tuples of the target's entity types (RelatedEntities or AttributeEntityMapping, with
+        the value of a multi-valued attribute) that are not positive examples. Folds run in parallel, each from
+        a seed drawn from random.Random(seed).
+        '''
+        if target is None:
+            target = dictionaries.target
+        if argument_types(target, dictionaries.relations_dict, dictionaries.attribute_dict) is None:
+            raise ExceptionCase('Error [1]: Target is not a relation or attribute in the diagram: "' + str(target) + '"')
+        if not os.path.isdir(dataset_dir):
+            raise ExceptionCase('Error [1]: Dataset directory does not exist: "' + dataset_dir + '"')
+        if not dataset_folds(dataset_dir):
+            raise ExceptionCase('Error [1]: Dataset directory has no train* or test* folds: "' + dataset_dir + '"')
+        self.dictionaries = dictionaries
+        self.dataset_dir = dataset_dir
+        self.target = target
+        self.ratio = ratio
+        self.seed = seed
+        self.processes = processes
+        self.verbose = verbose
 
-        # Handle "Unexplored" attributes, relations, and entities
-        for predicate in unexplored:
-            if predicate in self.attribute_dict:
-                
-                # Note: multivalued attributes need to be handled as #, while non-multivalued need nothing.
-                if predicate in self.multi_value_attributes:
-                    multi = ',#' + predicate.lower()
-                else:
-                    multi = ''
+    def jobs(self):
+        rng = random.Random(self.seed)
+        for fold in dataset_folds(self.dataset_dir):
+            yield (os.path.join(self.dataset_dir, fold), fold, self.target, self.dictionaries.relations_dict,
+                   self.dictionaries.attribute_dict, self.dictionaries.multi_value_attributes, self.ratio,
+                   rng.randint(0, 2**31 - 1))
 
-                final_set.append(str(predicate +
-                                     '(+' + self.attribute_dict[predicate] + multi +
-                                     ').'))
+    def run(self):
+        '''Returns (filename, positives, negatives) for every fold.'''
+        results = list(run_jobs(sample_fold_negatives, self.jobs(), self.processes))
+        if self.verbose:
+            for filename, positives, negatives in results:
+                print(filename + ':', positives, 'positives,', negatives, 'negatives')
+        return results
+
+# FeatureRanking: order the Important features by how well they separate the positive and negative examples.
+
+def fold_feature_counts(job):
+    '''
+    job is (fold directory, fold, target). Streams the fold's examples of target, then its facts twice, and
+    returns (positives, negatives, {predicate: [facts, positives covered, negatives covered]}).
+
+    A fact covers an example if it mentions one of the example's constants. The first pass over the facts also
+    links every other constant of such a fact to the example, so the second pass can cover examples one join
+    away: a fact without example constants covers the examples shared by all of its linked constants (e.g.
+    token(tw, p04, b1209) covers infield_ftitle(b1209_p04) through isbibpos(b1209_p04, b1209, p04)).
+    Memory grows with the number of examples, not with the number of facts.
+    '''
+    fold_dir, fold, target = job
+    prefix = os.path.join(fold_dir, fold)
+
+    examples = []  # example id -> its constants, positives first
+    mentions = {}  # constant -> ids of the examples it is an argument of
+    positives = 0
+    for suffix in ['_pos.txt', '_neg.txt']:
+        if not os.path.exists(prefix + suffix):
+            continue
+        for predicate, constants in read_facts(prefix + suffix):
+            if predicate != target:
+                continue
+            for constant in constants:
+                mentions.setdefault(constant, []).append(len(examples))
+            examples.append(set(constants))
+        if suffix == '_pos.txt':
+            positives = len(examples)
+
+    counts = OrderedDict() # predicate -> number of facts
+    covered = {}           # predicate -> one byte per example, 1 if a fact of the predicate covers it
+    links = {}             # constant -> ids of the examples it shares a fact with
+    facts_file = prefix + '_facts.txt'
+    for step in ['direct', 'linked']:
+        if not os.path.exists(facts_file):
+            break
+        for predicate, constants in read_facts(facts_file):
+            if predicate == target:
+                # Facts about the target would give the labels away.
+                continue
+            direct = set()
+            for constant in constants:
+                direct.update(mentions.get(constant, ()))
+            if step == 'direct':
+                counts[predicate] = counts.get(predicate, 0) + 1
+                if predicate not in covered:
+                    covered[predicate] = bytearray(len(examples))
+                for example in direct:
+                    covered[predicate][example] = 1
+                    for constant in constants:
+                        if constant not in examples[example]:
+                            links.setdefault(constant, set()).add(example)
+            elif not direct:
+                linked = sorted((links[constant] for constant in constants if constant in links), key=len)
+                if linked:
+                    for example in linked[0].intersection(*linked[1:]):
+                        covered[predicate][example] = 1
+
+    negatives = len(examples) - positives
+    return positives, negatives, dict((predicate, [facts, covered[predicate][:positives].count(b'\x01'),
+                                                   covered[predicate][positives:].count(b'\x01')])
+                                      for predicate, facts in counts.items())
+
+def entropy(positives, negatives):
+    total = float(positives + negatives)
+    result = 0.0
+    for count in (positives, negatives):
+        if count:
+            result -= count / total * math.log(count / total, 2)
+    return result
+
+class FeatureRanking:
+
+    def __init__(self, dictionaries, dataset_dir, target=None, processes=None, verbose=False):
+        '''
+        Ranks the Important features of dictionaries with the examples and facts of the train folds of dataset_dir
+        (the test folds are never read). Folds are counted in parallel, see fold_feature_counts.
+        '''
+        if target is None:
+            target = dictionaries.target
+        if not os.path.isdir(dataset_dir):
+            raise ExceptionCase('Error [1]: Dataset directory does not exist: "' + dataset_dir + '"')
+        self.folds = [fold for fold in dataset_folds(dataset_dir) if fold.startswith('train')]
+        if not self.folds:
+            raise ExceptionCase('Error [1]: Dataset has no train folds: "' + dataset_dir + '"')
+        self.dictionaries = dictionaries
+        self.dataset_dir = dataset_dir
+        self.target = target
+        self.processes = processes
+        self.verbose = verbose
 
-            elif predicate in self.relations_dict:
-                out = []
+    def jobs(self):
+        for fold in self.folds:
+            yield (os.path.join(self.dataset_dir, fold), fold, self.target)
+
+    def statistics(self):
+        '''Returns (positives, negatives, {predicate: [facts, positives covered, negatives covered]}) over the train folds.'''
+        positives, negatives, totals = 0, 0, {}
+        for fold_positives, fold_negatives, counts in run_jobs(fold_feature_counts, self.jobs(), self.processes):
+            positives += fold_positives
+            negatives += fold_negatives
+            for predicate, fold_counts in counts.items():
+                totals[predicate] = [total + count for total, count in zip(totals.get(predicate, [0, 0, 0]), fold_counts)]
+        return positives, negatives, totals
+
+    def rank(self):
+        '''
+        The Important features, best first, as (feature, gain, coverage): gain is the information gain of splitting
+        the examples into covered and not covered, coverage the fraction of the examples covered. Ties (e.g. when
+        there are no negatives) go to the higher coverage, then to the original order of the Important list.
+        '''
+        positives, negatives, totals = self.statistics()
+        if not positives + negatives:
+            raise ExceptionCase('Error [1]: No examples of the target in the train folds: "' + self.target + '"')
+        examples = float(positives + negatives)
+        before = entropy(positives, negatives)
+
+        ranking = []
+        for feature in self.dictionaries.importants:
+            facts, covered_positives, covered_negatives = totals.get(feature, [0, 0, 0])
+            covered = covered_positives + covered_negatives
+            after = (covered / examples * entropy(covered_positives, covered_negatives) +
+                     (examples - covered) / examples * entropy(positives - covered_positives, negatives - covered_negatives))
+            ranking.append((feature, before - after, covered / examples))
+            if self.verbose:
+                print(feature + ':', facts, 'facts, covers', covered_positives, 'of', positives, 'positives and',
+                      covered_negatives, 'of', negatives, 'negatives')
+        order = dict((feature, i) for i, feature in enumerate(self.dictionaries.importants))
+        # Rounded, so that gains differing only by floating point error count as ties.
+        ranking.sort(key=lambda entry: (-round(entry[1], 12), -entry[2], order[entry[0]]))
+        return ranking
+
+    def apply(self):
+        '''Reorder dictionaries.importants (what --number counts from) by rank(), and return the ranking.'''
+        ranking = self.rank()
+        self.dictionaries.importants = [feature for feature, gain, coverage in ranking]
+        return ranking
+
+# Process pool workers: each worker receives the parsed diagram once, through the pool initializer.
+
+def run_jobs(function, jobs, processes=None, initializer=None, initargs=(), chunksize=1):
+    '''
+    Yields function(job) for every job, in the order of jobs. With processes == 1, or a single job, the jobs run
+    in this process after initializer(*initargs); otherwise in a multiprocessing.Pool of processes workers (the
+    number of CPUs for None), each started with initializer(*initargs). The pool is shut down after the last result.
+    '''
+    jobs = list(jobs)
+    if processes == 1 or len(jobs) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for job in jobs:
+            yield function(job)
+        return
+    pool = multiprocessing.Pool(processes, initializer, initargs)
+    try:
+        for result in pool.imap(function, jobs, chunksize):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+pool_walker = None
+
+def init_pool_worker(dictionaries, budgets=None, paths=None, stats=False):
+    global pool_walker
+    pool_walker = walker(None, dictionaries=dictionaries, stats=stats, **(budgets or {}))
+    if paths:
+        # Paths walked by the parent process, so the workers only instantiate them.
+        pool_walker.paths.update(paths)
+
+def run_pool_job(job):
+    '''
+    job is (name, mode, target, features, number, seed); returns (name, modes, stats), where stats is the
+    Stats.as_dict() of this job for the parent process to merge, or None when the worker records no stats.
+    '''
+    name, mode, target, features, number, seed = job
+    if pool_walker.stats is None:
+        return name, pool_walker.modes(mode, target, features, number, seed), None
+    # A new Stats for every job, so the parent can add them up without counting anything twice.
+    pool_walker.stats = pool_walker.dictionaries.stats = Stats()
+    modes = pool_walker.modes(mode, target, features, number, seed)
+    return name, modes, pool_walker.stats.as_dict()
+
+# TargetBatch: produce the modes for every candidate target of one diagram in a single run.
+
+class TargetBatch:
+
+    def __init__(self, dictionaries, mode, targets=None, number=None, processes=None, verbose=False, budgets=None,
+                 stats=None):
+        '''
+        targets defaults to every relation and attribute that can be a target (is in RelatedEntities or has an
+        attribute edge). Walk and shortest modes use the Important features, minus the target itself.
+        budgets are the max_depth, max_paths and time_budget keywords of the walker class. The workers' timings
+        and counters are added to stats (a Stats), when given.
+        '''
+        self.dictionaries = dictionaries
+        self.budgets = budgets
+        self.stats = stats
+        self.mode = mode
+        self.number = number
+        self.processes = processes
+        self.verbose = verbose
 
-                variables = self.relations_dict[predicate]
-                # reverse the order of the variables for correct predicate logic format:
-                #variables = list(reversed(variables))
-                
-                for var in variables:
-                    out.append("+%s" % var)
-                    # A small fix for reflexive relationships:
-                    if len(variables) == 1:
-                        out.append("+%s" % var)
-                final_set.append(str(predicate + '(' + ','.join(out) + ').'))
+        candidates = set(dictionaries.relations_dict.keys()).union(set(dictionaries.attribute_dict.keys()))
+        if targets is None:
+            targets = sorted(candidates)
+        for target in targets:
+            if target not in candidates:
+                raise ExceptionCase('Error [1]: Target is not a relation or attribute in the diagram: "' + target + '"')
+        self.targets = targets
+
+    def jobs(self):
+        for target in self.targets:
+            features = None
+            if self.mode in ('walk', 'shortest'):
+                features = [feature for feature in self.dictionaries.importants if feature != target]
+                if (self.number != None):
+                    features = features[:self.number]
+            # Random modes get their seeds here, so the run only depends on the state of this process.
+            seed = random.randint(0, 2**31 - 1)
+            yield (target, self.mode, target, features, self.number, seed)
+
+    def run(self, output_dir):
+        '''Write <output_dir>/<target>.txt for every target and return the list of files.'''
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        # In this process, the jobs share the dictionaries and replace their stats: put them back afterwards.
+        previous_stats = getattr(self.dictionaries, 'stats', None)
+        results = run_jobs(run_pool_job, self.jobs(), self.processes, init_pool_worker,
+                           (self.dictionaries, self.budgets, None, self.stats is not None))
+
+        written = []
+        try:
+            for target, modes, job_stats in results:
+                if job_stats is not None:
+                    self.stats.merge(job_stats)
+                filename = os.path.join(output_dir, target + '.txt')
+                write_modes(filename, target, modes)
+                written.append(filename)
+                if self.verbose:
+                    print('Wrote', len(modes), 'modes to', filename)
+        finally:
+            self.dictionaries.stats = previous_stats
+        return sorted(written)
+
+# FeatureSamples: many -r runs on one target, sharing the walks to each feature.
+
+class FeatureSamples:
+
+    def __init__(self, dictionaries, samples, target=None, number=None, seed=None, processes=None, verbose=False,
+                 budgets=None, stats=None):
+        '''
+        Draw samples random feature subsets for target (default: the diagram's target), the way -r does, from a
+        random.Random(seed). Each feature is walked to once and subsets that give the same modes share a file.
+        budgets are the max_depth, max_paths and time_budget keywords of the walker class; with any of them set,
+        every subset is walked on its own, within the budgets. The workers' timings and counters are added to
+        stats (a Stats), when given.
+        '''
+        self.dictionaries = dictionaries
+        self.samples = samples
+        self.number = number
+        self.seed = seed
+        self.processes = processes
+        self.verbose = verbose
+        self.budgets = budgets or {}
+        self.stats = stats
+        self.walker = walker(None, verbose=verbose, dictionaries=dictionaries, **self.budgets)
+        self.target = self.walker.check_target(target)
 
-        self.all_modes = ['mode: ' + element for element in sorted(list(set(final_set)))]
-        self.all_modes_boostsrl = [element for element in sorted(list(set(final_set)))]
-        #print('\n//background')
-        #print('//target is', target)
-        #for mode in self.all_modes:
-        #    print(mode)
+    def draw(self):
+        rng = random.Random(self.seed)
+        return [self.walker.draw_features(self.target, self.number, rng) for _ in range(self.samples)]
 
-class UnitTests:
+    def run(self, output_dir):
+        '''
+        Write <output_dir>/<target>_sample_<i>.txt for every distinct mode set, and manifest.json recording the
+        features and the file of each sample. Returns the list of files.
+        '''
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        drawn = self.draw()
+        # The order of the features does not change the modes, so each subset is only instantiated once.
+        subsets = OrderedDict()
+        for features in drawn:
+            subsets.setdefault(frozenset(features), features)
+
+        # Walk to every feature that was drawn in one traversal, then hand the paths to the workers. Budgets
+        # apply to each walk, so the paths of a budgeted walk are not shared (see walker.feature_paths).
+        if not any(budget is not None for budget in self.budgets.values()):
+            networks = Networks(self.target, sorted(set(itertools.chain(*drawn))), self.dictionaries,
+                                verbose=self.verbose)
+            self.walker.feature_paths(networks)
+
+        jobs = [(key, 'walk', self.target, features, None, None) for key, features in subsets.items()]
+        files = {}   # subset -> file
+        written = {} # hash of the modes -> file
+        # In this process, the jobs share the dictionaries and replace their stats: put them back afterwards.
+        previous_stats = getattr(self.dictionaries, 'stats', None)
+        results = run_jobs(run_pool_job, jobs, self.processes, init_pool_worker,
+                           (self.dictionaries, self.budgets, self.walker.paths, self.stats is not None))
+        try:
+            for key, modes, job_stats in results:
+                if job_stats is not None:
+                    self.stats.merge(job_stats)
+                digest = hashlib.sha1('\n'.join(modes).encode('utf-8')).hexdigest()
+                if digest not in written:
+                    filename = os.path.join(output_dir, self.target + '_sample_' + str(len(written) + 1) + '.txt')
+                    write_modes(filename, self.target, modes)
+                    written[digest] = filename
+                    if self.verbose:
+                        print('Wrote', len(modes), 'modes to', filename)
+                files[key] = written[digest]
+        finally:
+            self.dictionaries.stats = previous_stats
+
+        manifest = {'target': self.target, 'seed': self.seed, 'number': self.number,
+                    'samples': [{'features': features, 'file': os.path.basename(files[frozenset(features)])}
+                                for features in drawn]}
+        write_file_atomically(os.path.join(output_dir, 'manifest.json'), json.dumps(manifest, indent=2, sort_keys=True))
+        return sorted(written.values())
+
+# DiagramBatch: one mode for many diagram files, e.g. a directory of generated schemas, in a single run.
+
+def run_diagram_job(job):
+    '''
+    job is (diagram file, output file, mode, number, seed, budgets, stats, background). Writes the modes of the
+    diagram's target to the output file and returns (its entry in index.json, the Stats.as_dict() of the run
+    when stats is True). A diagram that cannot be read, parsed or walked, or whose modes cannot be written, gets
+    an error; anything else is a bug and is raised. background is None, or the (dataset directory, settings) of
+    a BackgroundWriter to write the modes to as well.
+    '''
+    filename, output, mode, number, seed, budgets, stats, background = job
+    entry = {'diagram': filename, 'output': None, 'target': None, 'modes': 0, 'error': None, 'background': None}
+    started = time.time()
+    parsed = None
+    try:
+        diagram = read_diagram(filename)
+        try:
+            parsed = walker(diagram, stats=stats, **budgets)
+        except (IndexError, KeyError, ValueError) as error:
+            # The parser assumes a well-formed diagram, e.g. that every node has a style after its '='.
+            raise ExceptionCase('Error [1]: Could not parse the diagram (' + type(error).__name__ + ': ' +
+                                str(error) + ')')
+        modes = parsed.modes(mode, None, None, number, seed)
+        write_modes(output, parsed.dictionaries.target, modes)
+        entry.update(output=output, target=parsed.dictionaries.target, modes=len(modes))
+        if background is not None:
+            writer = BackgroundWriter(*background)
+            writer.write([(parsed.dictionaries.target, modes)])
+            entry['background'] = writer.filename
+    except ExceptionCase as error:
+        entry['error'] = str(error)
+    except (IOError, OSError) as error:
+        entry['error'] = 'Error [1]: Could not write the modes (' + type(error).__name__ + ': ' + str(error) + ')'
+    entry['seconds'] = round(time.time() - started, 6)
+    if parsed is None or parsed.stats is None:
+        return entry, None
+    return entry, parsed.stats.as_dict()
+
+class DiagramBatch:
+
+    def __init__(self, pattern, mode, number=None, processes=None, verbose=False, budgets=None, stats=None,
+                 datasets_dir=None, settings=None):
+        '''
+        pattern is a directory (every *.mayukh file in it) or a glob of diagram files. Each diagram is parsed and
+        walked from its own target by a worker process, with the Important features limited to number.
+        budgets are the max_depth, max_paths and time_budget keywords of the walker class. The timings and
+        counters of every diagram are added to stats (a Stats), when given.
+        With datasets_dir, the modes of <name>.mayukh are also written as the background file of the dataset
+        datasets_dir/<name> (see BackgroundWriter, with settings); diagrams without a dataset are only reported.
+        '''
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.mayukh')
+        self.files = sorted(filename for filename in glob.glob(pattern) if os.path.isfile(filename))
+        if not self.files:
+            raise ExceptionCase('Error [1]: No diagram files match: "' + pattern + '"')
+        self.mode = mode
+        self.number = number
+        self.processes = processes
+        self.verbose = verbose
+        self.budgets = budgets or {}
+        self.stats = stats
+        self.datasets_dir = datasets_dir
+        self.settings = settings
+
+    def background(self, name):
+        if self.datasets_dir is None:
+            return None
+        dataset_dir = os.path.join(self.datasets_dir, name)
+        if not os.path.isdir(dataset_dir):
+            print('No dataset for', name + ', not writing its background file:', dataset_dir)
+            return None
+        return (dataset_dir, self.settings)
+
+    def jobs(self, output_dir):
+        names = set()
+        for filename in self.files:
+            # Files with the same name in different directories get _2, _3, ... instead of overwriting each other.
+            name = os.path.splitext(os.path.basename(filename))[0]
+            unique, copy = name, 1
+            while unique in names:
+                copy += 1
+                unique = name + '_' + str(copy)
+            names.add(unique)
+            # Random modes get their seeds here, so the run only depends on the state of this process.
+            seed = random.randint(0, 2**31 - 1)
+            yield (filename, os.path.join(output_dir, unique + '.txt'), self.mode, self.number, seed, self.budgets,
+                   self.stats is not None, self.background(name))
+
+    def run(self, output_dir):
+        '''
+        Write <output_dir>/<diagram>.txt for every diagram as soon as it is walked, then <output_dir>/index.json.
+        Returns the index entries, in the order of the diagram files.
+        '''
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        jobs = list(self.jobs(output_dir))
+        # Hand out the diagrams a few at a time: thousands of small jobs would otherwise be dominated by the IPC.
+        chunksize = max(1, len(jobs) // (4 * (self.processes or multiprocessing.cpu_count())))
+
+        entries = []
+        for job, (entry, job_stats) in zip(jobs, run_jobs(run_diagram_job, jobs, self.processes, chunksize=chunksize)):
+            if job_stats is not None:
+                # Diagrams may share target and feature names: their paths per feature are kept under the output name.
+                self.stats.merge(job_stats, prefix=os.path.splitext(os.path.basename(job[1]))[0])
+            entries.append(entry)
+            if entry['error'] is not None:
+                print(entry['diagram'] + ':', entry['error'])
+            elif self.verbose:
+                print('Wrote', entry['modes'], 'modes to', entry['output'])
+
+        entries.sort(key=lambda entry: entry['diagram'])
+        index = {'mode': self.mode, 'number': self.number, 'diagrams': entries}
+        write_file_atomically(os.path.join(output_dir, 'index.json'), json.dumps(index, indent=2, sort_keys=True) + '\n')
+        return entries
+
+# ModeServer: a long-running process answering mode requests, so callers do not pay for startup and parsing.
+
+server_walkers = OrderedDict() # In each worker process: diagram id -> walker, least recently used first.
+
+def run_server_job(job):
+    '''job is (diagram id, diagram, cache size, mode, target, features, number, seed, boostsrl); returns the modes.'''
+    key, diagram, cache_size, mode, target, features, number, seed, boostsrl = job
+    parsed = server_walkers.pop(key, None)
+    if parsed is None:
+        parsed = walker(diagram)
+    # The walker keeps the parsed diagram, the paths to each feature and the remembered results.
+    server_walkers[key] = parsed
+    while len(server_walkers) > cache_size:
+        server_walkers.popitem(last=False)
+    return parsed.modes(mode, target, features, number, seed, boostsrl)
+
+class ModeServer:
+
+    def __init__(self, address='127.0.0.1:8765', processes=None, cache_size=32, verbose=False):
+        '''
+        address is host:port, or the path of a Unix socket. Requests and responses are JSON objects, one per line:
+            {"diagram": "<contents of a diagram file>" or "diagram_id": "...", "target": ..., "mode": "walk",
+             "number": ..., "seed": ..., "features": [...], "boostsrl": false, "id": <echoed back>}
+        and the answer is {"id": ..., "diagram_id": ..., "modes": [...]} or {"id": ..., "error": "..."}.
+        Diagrams are known by the sha1 of their contents, so a diagram only has to be sent once. The last
+        cache_size diagrams are kept parsed (with their paths) in every worker, and modes are computed in a
+        pool of processes so that a long walk does not hold up the other requests.
+        '''
+        self.address = address
+        self.processes = processes
+        self.cache_size = cache_size
+        self.verbose = verbose
+        self.diagrams = OrderedDict() # diagram id -> contents, least recently used first
+        self.results = OrderedDict()  # request -> modes, for the requests that always give the same answer
+
+    def remember(self, cache, key, value, size):
+        cache.pop(key, None)
+        cache[key] = value
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+    def add_diagram(self, diagram):
+        if (len(diagram.splitlines()) != 6):
+            raise ExceptionCase('Error [1]: Diagram has the wrong number of lines.')
+        key = hashlib.sha1(diagram.encode('utf-8')).hexdigest()
+        self.remember(self.diagrams, key, diagram, self.cache_size)
+        return key
+
+    modes = ['walk', 'shortest', 'exhaustive', 'random', 'randomwalk', 'nowalk']
+
+    def field(self, request, name, kind, default=None):
+        '''request[name] if it is a kind (str, int or bool) or missing/null, otherwise raise ExceptionCase.'''
+        value = request.get(name)
+        if value is None:
+            return default
+        # JSON true and false are ints to isinstance, but not a number of features.
+        if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+            raise ExceptionCase('Error [1]: "' + name + '" must be ' + {str: 'a string', int: 'an integer',
+                                                                       bool: 'true or false'}[kind] + '.')
+        return value
+
+    def job(self, request):
+        '''Turn a request into a job for run_server_job, or raise ExceptionCase.'''
+        if not isinstance(request, dict):
+            raise ExceptionCase('Error [1]: A request is a JSON object.')
+        diagram = self.field(request, 'diagram', str)
+        diagram_id = self.field(request, 'diagram_id', str)
+        if diagram is not None:
+            key = self.add_diagram(diagram)
+        elif diagram_id in self.diagrams:
+            key = diagram_id
+            self.remember(self.diagrams, key, self.diagrams[key], self.cache_size)
+        else:
+            raise ExceptionCase('Error [1]: Unknown diagram_id, send the diagram instead: "' + str(diagram_id) + '"')
+        mode = self.field(request, 'mode', str, 'walk')
+        if mode not in self.modes:
+            raise ExceptionCase('Error [1]: Unknown mode: "' + mode + '"')
+        features = request.get('features')
+        if features is not None:
+            if not isinstance(features, list) or not all(isinstance(feature, str) for feature in features):
+                raise ExceptionCase('Error [1]: "features" must be a list of strings.')
+            features = tuple(features)
+        # Every part of the job is a string, number, bool, None or tuple of strings, so it can be a cache key.
+        return (key, self.diagrams[key], self.cache_size, mode, self.field(request, 'target', str), features,
+                self.field(request, 'number', int), self.field(request, 'seed', int),
+                self.field(request, 'boostsrl', bool, False))
+
+    def repeatable(self, job):
+        mode, seed = job[3], job[7]
+        return mode not in ('random', 'randomwalk') or seed is not None
+
+    def serve(self):
+        '''Serve until interrupted.'''
+        import asyncio
+        from concurrent.futures import ProcessPoolExecutor
+
+        server = self
+        loop = asyncio.new_event_loop()
+        executor = ProcessPoolExecutor(self.processes)
+
+        class Connection(asyncio.Protocol):
+
+            def connection_made(self, transport):
+                self.transport = transport
+                self.buffer = b''
+
+            def data_received(self, data):
+                self.buffer += data
+                while b'\n' in self.buffer:
+                    line, self.buffer = self.buffer.split(b'\n', 1)
+                    if line.strip():
+                        try:
+                            self.request(line)
+                        except Exception as error:
+                            # Anything job() did not anticipate: answer, rather than drop the connection.
+                            self.respond({'error': 'Error [1]: Could not handle the request (' +
+                                                   type(error).__name__ + ': ' + str(error) + ')'})
+
+            def respond(self, response):
+                if not self.transport.is_closing():
+                    self.transport.write(json.dumps(response).encode('utf-8') + b'\n')
+
+            def request(self, line):
+                response = {}
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    if isinstance(request, dict):
+                        response['id'] = request.get('id')
+                    job = server.job(request)
+                except (ValueError, ExceptionCase) as error:
+                    response['error'] = str(error)
+                    self.respond(response)
+                    return
+                response['diagram_id'] = job[0]
+
+                # The diagram itself is not part of the key: its id already says which one it is.
+                key = job[:1] + job[3:]
+                if key in server.results:
+                    response['modes'] = server.results[key]
+                    self.respond(response)
+                    return
+
+                def finished(future):
+                    try:
+                        response['modes'] = future.result()
+                    except Exception as error:
+                        response['error'] = str(error)
+                    else:
+                        if server.repeatable(job):
+                            server.remember(server.results, key, response['modes'], 1024)
+                    self.respond(response)
+                loop.run_in_executor(executor, run_server_job, job).add_done_callback(finished)
+
+        unix = ':' not in self.address or '/' in self.address
+        if not unix:
+            host, port = self.address.rsplit(':', 1)
+            listener = loop.run_until_complete(loop.create_server(Connection, host, int(port)))
+        else:
+            listener = loop.run_until_complete(loop.create_unix_server(Connection, self.address))
+        print('Serving modes on', self.address)
+        for name in ('SIGINT', 'SIGTERM'):
+            try:
+                loop.add_signal_handler(getattr(signal, name), loop.stop)
+            except (AttributeError, NotImplementedError):
+                # Windows event loops have no signal handlers: Ctrl-C still ends up in KeyboardInterrupt.
+                pass
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+            loop.run_until_complete(listener.wait_closed())
+            executor.shutdown()
+            loop.close()
+            if unix:
+                os.remove(self.address)
 
-    def __init__(self):
-        pass
+# DiagramGenerator: synthetic diagrams in the 6-line format, for benchmarks.
 
-    def run_unit_tests(self):
-        pass
+class DiagramGenerator:
 
-class walker:
+    def __init__(self, entities=4, relations=4, attributes=3, arity=2, density=0.5, reflexive=0, multi_valued=0,
+                 features=None, seed=None):
+        '''
+        entities, relations and attributes are the number of nodes of each kind. A relation is reflexive (one entity
+        type, like advisedby=[Person]) for the first reflexive relations, otherwise it has between 2 and arity
+        arguments: two, plus each further argument with probability density. multi_valued attributes get their
+        own value column (like hasposition=[Person, hasposition]). features is the length of the Important list.
+        '''
+        if entities < 1:
+            raise ExceptionCase('Error [1]: A diagram needs at least one entity.')
+        if relations < 1:
+            raise ExceptionCase('Error [1]: A diagram needs at least one relation.')
+        if arity < 2:
+            raise ExceptionCase('Error [1]: Relations have at least two arguments.')
+        self.entities = entities
+        self.relations = relations
+        self.attributes = attributes
+        self.arity = arity
+        self.density = density
+        self.reflexive = min(reflexive, relations)
+        self.multi_valued = min(multi_valued, attributes)
+        self.features = features
+        self.seed = seed
+
+    def generate(self):
+        '''Returns the diagram as a string.'''
+        rng = random.Random(self.seed)
+        entities = ['e%d' % i for i in range(self.entities)]
+        relations = ['r%d' % i for i in range(self.relations)]
+        attributes = ['a%d' % i for i in range(self.attributes)]
+
+        # Every relation touches an entity that is already connected, so the diagram is one component.
+        connected = [entities[0]]
+        related = OrderedDict()
+        for i, relation in enumerate(relations):
+            first = rng.choice(connected)
+            if i < self.reflexive:
+                related[relation] = [first]
+                continue
+            arguments = [first]
+            size = 2 + sum(1 for _ in range(self.arity - 2) if rng.random() < self.density)
+            unused = [entity for entity in entities if entity not in connected]
+            for _ in range(size - 1):
+                # Prefer entities that are not connected yet, until there are none left.
+                candidates = [entity for entity in (unused or entities) if entity not in arguments]
+                if not candidates:
+                    break
+                entity = rng.choice(candidates)
+                arguments.append(entity)
+                if entity in unused:
+                    unused.remove(entity)
+                    connected.append(entity)
+            related[relation] = arguments
+
+        mapping = OrderedDict((attribute, rng.choice(connected)) for attribute in attributes)
+
+        nodes = [entity + '=EntityNodeStyle' for entity in entities]
+        nodes += [relation + '=RelationNodeStyle' for relation in relations]
+        nodes += [attribute + '=AttributeNodeStyle' for attribute in attributes]
+        edges = []
+        for relation, arguments in related.items():
+            edges += [relation + '|' + entity + '=RelationEdge' for entity in arguments]
+        edges += [attribute + '|' + entity + '=AttributeEdge' for attribute, entity in mapping.items()]
+
+        target = relations[-1]
+        candidates = relations[:-1] + attributes
+        features = self.features
+        if features is None:
+            features = min(5, len(candidates))
+        importants = rng.sample(candidates, min(features, len(candidates))) or [target]
+
+        entity_mapping = []
+        for i, (attribute, entity) in enumerate(mapping.items()):
+            if i < self.multi_valued:
+                entity_mapping.append(attribute + '=[' + entity + ', ' + attribute + ']')
+            else:
+                entity_mapping.append(attribute + '=[' + entity + ']')
+
+        return '\n'.join(['Nodes: {' + ', '.join(nodes) + '}',
+                          'Edges: {' + ', '.join(edges) + '}',
+                          'Important: [' + ', '.join(importants) + ']',
+                          'Target: ' + target,
+                          'RelatedEntities: {' + ', '.join(relation + '=[' + ', '.join(arguments) + ']'
+                                                           for relation, arguments in related.items()) + '}',
+                          'AttributeEntityMapping: {' + ', '.join(entity_mapping) + '}']) + '\n'
+
+# Benchmark: time every mode on generated diagrams and compare with a stored baseline.
+
+class Benchmark:
+
+    # name -> DiagramGenerator keywords
+    configurations = OrderedDict([
+        ('small', {'entities': 4, 'relations': 5, 'attributes': 4, 'seed': 1}),
+        ('medium', {'entities': 10, 'relations': 14, 'attributes': 10, 'arity': 3, 'density': 0.3, 'seed': 2}),
+        ('reflexive', {'entities': 6, 'relations': 10, 'attributes': 6, 'reflexive': 4, 'multi_valued': 3, 'seed': 3}),
+        ('dense', {'entities': 8, 'relations': 10, 'attributes': 6, 'arity': 4, 'density': 0.5, 'seed': 4}),
+        ('large', {'entities': 40, 'relations': 45, 'attributes': 30, 'seed': 5}),
+    ])
+    modes = ['walk', 'shortest', 'exhaustive', 'random', 'randomwalk', 'nowalk']
+
+    def __init__(self, configurations=None, repeat=3, tolerance=0.5, verbose=False):
+        '''
+        Each mode runs repeat times and keeps its fastest time. A mode regresses when it takes more than
+        (1 + tolerance) times its baseline time or memory, or when it walks a different number of paths.
+        '''
+        if configurations is None:
+            configurations = self.configurations
+        self.configurations = configurations
+        self.repeat = repeat
+        self.tolerance = tolerance
+        self.verbose = verbose
 
-    """
-    "Main" class to run WalkER with the assumption that it was imported as a package.
-        - diagram_file -> a string
-        - method -> a string
-    """
+    def run_mode(self, dictionaries, mode):
+        '''Returns the number of paths walked (steps, for randomwalk).'''
+        target = dictionaries.target
+        features = []
+        if mode in ('walk', 'shortest'):
+            features = dictionaries.importants
+        elif mode == 'exhaustive':
+            features = sorted(set(dictionaries.relations).union(set(dictionaries.attributes)) - set([target]))
+        elif mode == 'random':
+            rng = random.Random(0)
+            all_features = sorted(set(dictionaries.relations).union(set(dictionaries.attributes)) - set([target]))
+            features = rng.sample(all_features, rng.randint(1, len(all_features)))
+
+        networks = Networks(target, features, dictionaries)
+        if mode == 'randomwalk':
+            return networks.random_walk(networks.graph, networks.target_id, 10000, rng=random.Random(0))
+        elif mode == 'nowalk':
+            networks.nowalk()
+            return 0
+        elif mode == 'shortest':
+            all_paths = networks.shortest_paths_from_target_to_features()
+        else:
+            all_paths = networks.paths_from_target_to_features()
+        networks.walkFeatures(all_paths, shortest=(mode == 'shortest'))
+        return sum(len(paths) for paths in all_paths)
 
-    def __init__(self, diagram_file_string, algo, shortest=False, verbose=False, n=10000):
-        pass
+    def measure(self, function):
+        '''Returns (fastest seconds, peak kilobytes or None without tracemalloc, result of the last call).'''
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        seconds = None
+        for _ in range(self.repeat):
+            start = time.time()
+            result = function()
+            elapsed = time.time() - start
+            if seconds is None or elapsed < seconds:
+                seconds = elapsed
+        peak = None
+        if tracemalloc is not None:
+            # Memory is measured on a separate call: tracing slows everything down.
+            tracemalloc.start()
+            function()
+            peak = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        return seconds, peak, result
+
+    def run(self):
+        '''Returns {configuration: {mode: {'seconds', 'peak_kb', 'paths'}}}.'''
+        results = OrderedDict()
+        for name, keywords in self.configurations.items():
+            diagram = DiagramGenerator(**keywords).generate()
+            results[name] = OrderedDict()
+            seconds, peak, dictionaries = self.measure(lambda: BuildDictionaries(diagram))
+            results[name]['parse'] = {'seconds': seconds, 'peak_kb': peak, 'paths': 0}
+            for mode in self.modes:
+                seconds, peak, paths = self.measure(lambda: self.run_mode(dictionaries, mode))
+                results[name][mode] = {'seconds': seconds, 'peak_kb': peak, 'paths': paths}
+                if self.verbose:
+                    print(name, mode, '%.4fs' % seconds, peak, 'KB', paths, 'paths')
+        return results
+
+    def compare(self, results, baseline):
+        '''Returns a list of regressions, as messages.'''
+        regressions = []
+        for name, modes in results.items():
+            for mode, result in modes.items():
+                if name not in baseline or mode not in baseline[name]:
+                    continue
+                expected = baseline[name][mode]
+                where = name + ' ' + mode + ': '
+                if result['paths'] != expected['paths']:
+                    regressions.append(where + 'walked ' + str(result['paths']) + ' paths, the baseline walked ' +
+                                       str(expected['paths']) + '.')
+                # Very short runs are all noise.
+                limit = max(expected['seconds'] * (1 + self.tolerance), expected['seconds'] + 0.005)
+                if result['seconds'] > limit:
+                    regressions.append(where + 'took %.4fs, the baseline took %.4fs.' % (result['seconds'], expected['seconds']))
+                if result['peak_kb'] is not None and expected['peak_kb'] is not None and \
+                   result['peak_kb'] > max(expected['peak_kb'] * (1 + self.tolerance), expected['peak_kb'] + 64):
+                    regressions.append(where + 'used ' + str(result['peak_kb']) + ' KB, the baseline used ' +
+                                       str(expected['peak_kb']) + ' KB.')
+        return regressions
 
 if __name__ == '__main__':
 
     '''Parse the commandline input, import the file. Contents are stored in setup.diagram_file.'''
     setup = Setup()
-    diagram = setup.diagram_file
 
-    '''Turn turn the file into dictionaries and lists.'''
-    dictionaries = BuildDictionaries(diagram, verbose=setup.verbose)
+    if (setup.serve != None):
+        ModeServer(setup.serve, processes=setup.processes, verbose=setup.verbose).serve()
+        sys.exit(0)
+
+    if (setup.benchmark != None):
+        benchmark = Benchmark(verbose=setup.verbose)
+        results = benchmark.run()
+        if setup.update_baseline or not os.path.exists(setup.benchmark):
+            write_file_atomically(setup.benchmark, json.dumps(results, indent=2) + '\n')
+            print('Wrote the baseline to', setup.benchmark)
+            sys.exit(0)
+        with open(setup.benchmark) as f:
+            regressions = benchmark.compare(results, json.load(f))
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+        print('No regressions against', setup.benchmark)
+        sys.exit(0)
+
+    stats = None
+    if (setup.stats != None):
+        stats = Stats()
+        started = (time.time(), process_time())
+
+    if (setup.batch != None):
+        if (setup.seed != None):
+            random.seed(setup.seed)
+        batch = DiagramBatch(setup.batch, setup.mode, number=setup.Nfeatures, processes=setup.processes,
+                             verbose=setup.verbose,
+                             budgets=setup.budgets, stats=stats, datasets_dir=setup.write_bk, settings=setup.settings)
+        print('"Batch Mode":', len(batch.files), 'diagrams, written to', setup.output_dir)
+        entries = batch.run(setup.output_dir)
+        failed = len([entry for entry in entries if entry['error'] is not None])
+        print('Walked', len(entries) - failed, 'of', len(entries), 'diagrams,', failed, 'failed; see',
+              os.path.join(setup.output_dir, 'index.json'))
+        if stats is not None:
+            stats.report(started, setup.stats)
+        sys.exit(1 if failed else 0)
+    diagram = setup.diagram_file
 
-    if (setup.walk or setup.shortest):
+    '''Turn turn the file into dictionaries and lists, reusing a compiled copy when caching is enabled.'''
+    cache = None
+    if (setup.cache_dir != None):
+        cache = DiagramCache(setup.cache_dir or None, max_bytes=setup.cache_size * 1024 * 1024)
+    dictionaries = BuildDictionaries(diagram, verbose=setup.verbose, cache=cache, stats=stats)
+    networks = None
+
+    if (setup.seed != None):
+        random.seed(setup.seed)
+
+    if (setup.rank_dir != None):
+        with dictionaries.phase('rank'):
+            ranking = FeatureRanking(dictionaries, setup.rank_dir, target=(setup.targets or [None])[0],
+                                     processes=setup.processes,
+                                     verbose=setup.verbose).apply()
+        print('Important features ranked by information gain on the train folds of', setup.rank_dir + ':')
+        for feature, gain, coverage in ranking:
+            print('// %.4f %.3f %s' % (gain, coverage, feature))
+
+    if (setup.negatives_dir != None):
+        print('Sampling', setup.ratio, 'negative examples per positive for every fold of', setup.negatives_dir)
+        sampler = NegativeSampler(dictionaries, setup.negatives_dir, target=(setup.targets or [None])[0],
+                                  ratio=setup.ratio, seed=setup.seed, processes=setup.processes, verbose=setup.verbose)
+        for filename, positives, negatives in sampler.run():
+            print(filename, positives, negatives)
+
+    elif (setup.facts_file != None):
+        store = FactStore(setup.facts_file, dictionaries=dictionaries)
+        print('//predicate facts distinct-constants-per-argument')
+        for predicate in store.predicates():
+            print(predicate, store.count(predicate),
+                  ' '.join(str(len(store.constants(predicate, position))) for position in range(store.arity(predicate))))
+        for problem in store.check():
+            print('Warning:', problem)
+
+    elif (setup.targets != None):
+        print('"Batch Mode": Produce modes for each target, written to', setup.output_dir)
+        batch = TargetBatch(dictionaries, setup.mode, targets=setup.targets or None, number=setup.Nfeatures,
+                            processes=setup.processes, verbose=setup.verbose,
+                            budgets=setup.budgets, stats=stats)
+        for filename in batch.run(setup.output_dir):
+            print(filename)
+
+    elif (setup.walk or setup.shortest):
         target = dictionaries.target
         all_features = list(set(dictionaries.relations).union(set(dictionaries.attributes)) - set([target]))
 
@@ -557,15 +3435,33 @@ if __name__ == '__main__':
             features = dictionaries.importants[:setup.Nfeatures]
         print(features)
 
-        networks = Networks(target, features, dictionaries, verbose=setup.verbose)
-        
-        all_paths = networks.paths_from_target_to_features()
+        networks = Networks(target, features, dictionaries, verbose=setup.verbose, **setup.budgets)
 
         if setup.shortest:
-            networks.walkFeatures(all_paths, shortest=True)
+            all_paths = networks.shortest_paths_from_target_to_features()
         else:
-            networks.walkFeatures(all_paths)
+            all_paths = networks.paths_from_target_to_features()
+
+        if setup.sweep:
+            # One walk to every feature, then the modes for each prefix of the features.
+            print('"Sweep Mode": Write the modes for the first 1 to', len(features), 'features to', setup.output_dir)
+            if not os.path.isdir(setup.output_dir):
+                os.makedirs(setup.output_dir)
+            for number, modes in enumerate(networks.sweep_features(all_paths, shortest=setup.shortest), 1):
+                filename = os.path.join(setup.output_dir, target + '_' + str(number) + '.txt')
+                write_modes(filename, target, modes)
+                print(filename)
+        else:
+            networks.walkFeatures(all_paths, shortest=setup.shortest)
     
+    elif setup.random and (setup.samples != None):
+        print('"Random Mode":', setup.samples, 'random samples of features, written to', setup.output_dir)
+        samples = FeatureSamples(dictionaries, setup.samples, number=setup.Nfeatures, seed=setup.seed,
+                                 processes=setup.processes, verbose=setup.verbose, budgets=setup.budgets,
+                                 stats=stats)
+        for filename in samples.run(setup.output_dir):
+            print(filename)
+
     elif (setup.random or setup.exhaustive):
         # User-selected target
         target = dictionaries.target
@@ -590,7 +3486,7 @@ if __name__ == '__main__':
             print('"Exhaustive Mode": Walk the graph from the target to every feature.')
             features = all_features
 
-        networks = Networks(target, features, dictionaries, verbose=setup.verbose)
+        networks = Networks(target, features, dictionaries, verbose=setup.verbose, **setup.budgets)
         all_paths = networks.paths_from_target_to_features()
         networks.walkFeatures(all_paths)
     
@@ -599,7 +3495,7 @@ if __name__ == '__main__':
 
         target = dictionaries.target
         features = []
-        Graph = dictionaries.Graph
+        graph = dictionaries.compact_graph
 
         networks = Networks(target, features, dictionaries, verbose=setup.verbose)
 
@@ -609,13 +3505,35 @@ if __name__ == '__main__':
         else:
             depth_limit = setup.Nfeatures
 
-        path = networks.random_walk(Graph, target, depth_limit)
-        
+        if (setup.walks > 1):
+            networks.random_walk_ensemble(graph, networks.target_id, depth_limit, setup.walks,
+                                          seed=setup.seed, threshold=setup.threshold, window=setup.window)
+            print('Random walks stopped after', networks.walk_steps, 'steps in total (' +
+                  ', '.join(reason + ': ' + str(count) for reason, count in sorted(networks.walk_stop_reasons.items())) + ').')
+            print('Fraction of the', setup.walks, 'walks that produced each mode:')
+            for mode in sorted(networks.mode_frequencies):
+                print('// %.3f %s' % (networks.mode_frequencies[mode], mode))
+        else:
+            steps = networks.random_walk(graph, networks.target_id, depth_limit, window=setup.window)
+            print('Random walk stopped after', steps, 'steps (' + networks.walk_stop_reason + ').')
+
 
     elif setup.nowalk:
         print('"No-Walk Mode": Instantiate variables without walking.')
-        print('This is not currently implemented.')
-
-    print('//target is', networks.target)
-    for mode in networks.all_modes:
-        print(mode)
+        networks = Networks(dictionaries.target, [], dictionaries, verbose=setup.verbose)
+        networks.nowalk()
+
+    if networks is not None:
+        print('//target is', networks.target)
+        for mode in networks.all_modes:
+            print(mode)
+        if networks.budgeted():
+            print('//budget:', networks.budget_summary())
+
+        if (setup.write_bk != None):
+            writer = BackgroundWriter(setup.write_bk, setup.settings)
+            for filename in writer.write([(networks.target, networks.all_modes)]):
+                print('Wrote', filename)
+
+    if stats is not None:
+        stats.report(started, setup.stats)